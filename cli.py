@@ -1,9 +1,14 @@
 import argparse
-from tiktok_uploader import tiktok, Video
+from tiktok_uploader import tiktok, Video, batch, farm
 from tiktok_uploader.basics import eprint
 from tiktok_uploader.Config import Config
 import sys, os
 
+
+# Exit status of `upload` when the video was already sent to the user and is refused.
+DUPLICATE_EXIT_STATUS = 3
+
+
 if __name__ == "__main__":
     _ = Config.load(f"/home/{os.getlogin()}/TikTok_Uploader/config.txt")
     # print(Config.get().cookies_dir)
@@ -29,6 +34,21 @@ if __name__ == "__main__":
     upload_parser.add_argument("-bc", "--brandcontent", type=int, default=0)
     upload_parser.add_argument("-ai", "--ailabel", type=int, default=0)
     upload_parser.add_argument("-p", "--proxy", default="")
+    upload_parser.add_argument("-ad", "--allow-duplicate", type=int, default=0, choices=[0, 1], help="Upload even if this video was already uploaded to the user")
+    upload_parser.add_argument("-r", "--render", type=int, default=0, choices=[0, 1], help="Render the video with its title as caption before uploading it, hashed while it is encoded")
+
+    # Batch subcommand.
+    batch_parser = subparsers.add_parser("batch", help="Upload every video of a manifest file")
+    batch_parser.add_argument("-m", "--manifest", help="CSV or JSONL file with one upload per row, columns are named after the upload flags (user, video, youtube, title, schedule, ...)", required=True)
+    batch_parser.add_argument("-w", "--workers", type=int, default=4, help="Number of uploads running at the same time")
+    batch_parser.add_argument("-pa", "--per-account", type=int, default=1, help="Number of uploads running at the same time for one user")
+    batch_parser.add_argument("-r", "--report", default="batch_report.jsonl", help="JSON lines file the upload results are appended to")
+
+    # Render subcommand.
+    render_parser = subparsers.add_parser("render", help="Download and render every video of a manifest file without uploading")
+    render_parser.add_argument("-m", "--manifest", help="CSV or JSONL file with one video per row, columns are video or youtube, text, and optionally start and end in seconds", required=True)
+    render_parser.add_argument("-dw", "--download-workers", type=int, default=4, help="Number of Youtube downloads running at the same time")
+    render_parser.add_argument("-rw", "--render-workers", type=int, default=0, help="Number of render processes, one per CPU core if 0")
 
     # Show cookies
     show_parser = subparsers.add_parser("show", help="Show users and videos available for system.")
@@ -73,7 +93,46 @@ if __name__ == "__main__":
                     print(f'[-] {name}')
                 sys.exit(1)
 
-        tiktok.upload_video(args.users, args.video,  args.title, args.schedule, args.comment, args.duet, args.stitch, args.visibility, args.brandorganic, args.brandcontent, args.ailabel, args.proxy)
+        if args.render:
+            if not args.youtube:
+                video_obj = Video(os.path.join(os.getcwd(), Config.get().videos_dir, args.video), args.title)
+            # Fragmented, the parts are hashed as the encoder writes them.
+            args.video = video_obj.render_stream(output="fragmented")
+            if not args.video:
+                eprint("Video could not be rendered.")
+                sys.exit(1)
+
+        uploaded = tiktok.upload_video(args.users, args.video,  args.title, args.schedule, args.comment, args.duet, args.stitch, args.visibility, args.brandorganic, args.brandcontent, args.ailabel, args.proxy, args.allow_duplicate)
+        if uploaded is None:
+            # Already sent to this user, retrying won't change it.
+            sys.exit(DUPLICATE_EXIT_STATUS)
+        if not uploaded:
+            sys.exit(1)
+
+    elif args.subcommand == "batch":
+        rows = batch.load_manifest(args.manifest)
+        errors = batch.validate_rows(rows)
+        if errors:
+            for error in errors:
+                eprint(f"[-] {error}")
+            sys.exit(1)
+        results = batch.run_batch(rows, args.report, args.workers, args.per_account)
+        uploaded = sum(1 for result in results if result["status"] == "uploaded")
+        print(f"[+] {uploaded}/{len(results)} videos uploaded, report saved to {args.report}")
+        if uploaded != len(results):
+            sys.exit(1)
+
+    elif args.subcommand == "render":
+        results = farm.preprocess(farm.load_jobs(args.manifest), args.download_workers, args.render_workers or None)
+        for result in results:
+            if result["status"] == "rendered":
+                print(f"[+] {result['source']} -> {result['output']}")
+            else:
+                eprint(f"[-] {result['source']}: {result['error']}")
+        rendered = sum(1 for result in results if result["status"] == "rendered")
+        print(f"[+] {rendered}/{len(results)} videos rendered")
+        if rendered != len(results):
+            sys.exit(1)
 
     elif args.subcommand == "show":
         # if flag is c then show cookie names
@@ -94,6 +153,6 @@ if __name__ == "__main__":
             print("No flag provided. Use -c (show all cookies) or -v (show all videos).")
 
     else:
-        eprint("Invalid subcommand. Use 'login' or 'upload' or 'show'.")
+        eprint("Invalid subcommand. Use 'login' or 'upload' or 'batch' or 'render' or 'show'.")
 
 
@@ -14,7 +14,36 @@ class Config:
         "TMP_YOUTUBE_VIDEO_DIR": "",
         "LANG": "en", 
         "TIKTOK_BASE_URL": "https://www.tiktok.com/upload?lang=", 
-        "IMAGEMAGICK_BINARY": ""
+        "IMAGEMAGICK_BINARY": "",
+        "UPLOAD_CONCURRENCY": 4,
+        "UPLOAD_PART_RETRIES": 3,
+        "UPLOAD_PART_TIMEOUT": 60,
+        "SIGNER_URL": "http://127.0.0.1:8080/signature",
+        "SIGNATURE_CACHE_TTL": 300,
+        "SIGNATURE_CACHE_SIZE": 256,
+        "POLL_INITIAL_DELAY": 1.0,
+        "POLL_MAX_DELAY": 15.0,
+        "POLL_DEADLINE": 300,
+        "POLL_MAX_ATTEMPTS": 40,
+        "POLL_STATUS_DEADLINE": 60,
+        "HTTP_POOL_CONNECTIONS": 10,
+        "HTTP_POOL_MAXSIZE": 10,
+        "CACHE_DIR": "./CacheDir",
+        "MENTION_CACHE_TTL": 604800,
+        "MENTION_CACHE_SIZE": 10000,
+        "TAG_CACHE_TTL": 86400,
+        "TAG_CACHE_SIZE": 50000,
+        "RENDER_ENGINE": "ffmpeg",
+        "RENDER_THREADS": 0,
+        "RENDER_PRESET": "medium",
+        "RENDER_CRF": 23,
+        "RENDER_OUTPUT": "faststart",
+        "CAPTION_CACHE_SIZE": 104857600,
+        "DOWNLOAD_CACHE_MAX_BYTES": 2147483648,
+        "DOWNLOAD_CACHE_MAX_AGE": 604800,
+        "DOWNLOAD_CONCURRENCY": 4,
+        "DOWNLOAD_SEGMENT_SIZE": 9437184,
+        "DOWNLOAD_RETRIES": 3
     }
 
     _EXCLUDE = ["#"]
@@ -47,7 +76,7 @@ class Config:
                     continue
                 valid = False
                 for opt_name in Config._DEFAULT_OPTIONS.keys():
-                    if line.startswith(opt_name):
+                    if line.split("=")[0].strip() == opt_name:
                         valid = True
                         if opt_name == "TIKTOK_DIM":
                             config._insert_option(opt_name, tuple(line.split("=")[1].strip()))
@@ -65,7 +94,7 @@ class Config:
         return line.split("=")[1].strip().replace('"', '')
 
     def get_option_by_name(self, opt_name: str):
-        return self._options.get(opt_name)
+        return self._options.get(opt_name, Config._DEFAULT_OPTIONS.get(opt_name))
     
     def _insert_option(self, opt_name: str, value):
         self._options[opt_name] = value
@@ -129,3 +158,148 @@ class Config:
     def imagemagick_binary_path(self):
         """ImageMagick Binary path """
         return self.get_option_by_name("IMAGEMAGICK_BINARY")
+
+    @property
+    def upload_concurrency(self) -> int:
+        """Number of video parts uploaded in parallel"""
+        return int(self.get_option_by_name("UPLOAD_CONCURRENCY"))
+
+    @property
+    def upload_part_retries(self) -> int:
+        """Number of retries for a failed video part upload"""
+        return int(self.get_option_by_name("UPLOAD_PART_RETRIES"))
+
+    @property
+    def upload_part_timeout(self) -> int:
+        """Seconds a video part upload may wait to connect or for data before it is retried"""
+        return int(self.get_option_by_name("UPLOAD_PART_TIMEOUT"))
+
+    @property
+    def signer_url(self):
+        """Url of the persistent signature server"""
+        return self.get_option_by_name("SIGNER_URL")
+
+    @property
+    def signature_cache_ttl(self) -> int:
+        """Seconds a request signature is reused for"""
+        return int(self.get_option_by_name("SIGNATURE_CACHE_TTL"))
+
+    @property
+    def signature_cache_size(self) -> int:
+        """Maximum number of cached request signatures"""
+        return int(self.get_option_by_name("SIGNATURE_CACHE_SIZE"))
+
+    @property
+    def poll_initial_delay(self) -> float:
+        """Seconds waited before polling TikTok again the first time"""
+        return float(self.get_option_by_name("POLL_INITIAL_DELAY"))
+
+    @property
+    def poll_max_delay(self) -> float:
+        """Maximum seconds waited between two polls"""
+        return float(self.get_option_by_name("POLL_MAX_DELAY"))
+
+    @property
+    def poll_deadline(self) -> float:
+        """Seconds to wait for TikTok to accept the video post"""
+        return float(self.get_option_by_name("POLL_DEADLINE"))
+
+    @property
+    def poll_max_attempts(self) -> int:
+        """Maximum number of polls for one step"""
+        return int(self.get_option_by_name("POLL_MAX_ATTEMPTS"))
+
+    @property
+    def poll_status_deadline(self) -> float:
+        """Seconds to wait for a posted video to finish processing"""
+        return float(self.get_option_by_name("POLL_STATUS_DEADLINE"))
+
+    @property
+    def http_pool_connections(self) -> int:
+        """Number of hosts an upload session keeps connections to"""
+        return int(self.get_option_by_name("HTTP_POOL_CONNECTIONS"))
+
+    @property
+    def http_pool_maxsize(self) -> int:
+        """Number of keep-alive connections kept per host"""
+        return int(self.get_option_by_name("HTTP_POOL_MAXSIZE"))
+
+    @property
+    def cache_dir(self):
+        """Directory where local caches and indexes are stored"""
+        return self.get_option_by_name("CACHE_DIR")
+
+    @property
+    def mention_cache_ttl(self) -> int:
+        """Seconds a resolved mention user id is kept"""
+        return int(self.get_option_by_name("MENTION_CACHE_TTL"))
+
+    @property
+    def mention_cache_size(self) -> int:
+        """Maximum number of cached mention user ids"""
+        return int(self.get_option_by_name("MENTION_CACHE_SIZE"))
+
+    @property
+    def tag_cache_ttl(self) -> int:
+        """Seconds a verified hashtag or user is kept"""
+        return int(self.get_option_by_name("TAG_CACHE_TTL"))
+
+    @property
+    def tag_cache_size(self) -> int:
+        """Maximum number of cached verified hashtags and users"""
+        return int(self.get_option_by_name("TAG_CACHE_SIZE"))
+
+    @property
+    def render_engine(self):
+        """Engine rendering the final video, ffmpeg (one filter graph pass) or moviepy"""
+        return self.get_option_by_name("RENDER_ENGINE")
+
+    @property
+    def render_threads(self) -> int:
+        """Number of encoder threads, 0 lets the encoder choose"""
+        return int(self.get_option_by_name("RENDER_THREADS"))
+
+    @property
+    def render_preset(self):
+        """x264 preset used to encode the final video"""
+        return self.get_option_by_name("RENDER_PRESET")
+
+    @property
+    def render_crf(self) -> int:
+        """x264 constant rate factor used to encode the final video"""
+        return int(self.get_option_by_name("RENDER_CRF"))
+
+    @property
+    def render_output(self):
+        """Layout of the final video, faststart (index first) or fragmented (written as it is encoded)"""
+        return self.get_option_by_name("RENDER_OUTPUT")
+
+    @property
+    def caption_cache_size(self) -> int:
+        """Maximum size in bytes of the rendered captions cache"""
+        return int(self.get_option_by_name("CAPTION_CACHE_SIZE"))
+
+    @property
+    def download_cache_max_bytes(self) -> int:
+        """Maximum size in bytes of the downloaded Youtube videos cache"""
+        return int(self.get_option_by_name("DOWNLOAD_CACHE_MAX_BYTES"))
+
+    @property
+    def download_cache_max_age(self) -> int:
+        """Seconds an unused downloaded Youtube video is kept"""
+        return int(self.get_option_by_name("DOWNLOAD_CACHE_MAX_AGE"))
+
+    @property
+    def download_concurrency(self) -> int:
+        """Number of byte ranges of a Youtube stream downloaded in parallel"""
+        return int(self.get_option_by_name("DOWNLOAD_CONCURRENCY"))
+
+    @property
+    def download_segment_size(self) -> int:
+        """Size in bytes of each byte range of a Youtube stream download"""
+        return int(self.get_option_by_name("DOWNLOAD_SEGMENT_SIZE"))
+
+    @property
+    def download_retries(self) -> int:
+        """Number of retries for a failed byte range download"""
+        return int(self.get_option_by_name("DOWNLOAD_RETRIES"))
@@ -1,9 +1,14 @@
 from .Config import Config
+from .ffmpeg import mux, render_stream, probe, trim
+from .captions import caption_image
+from .download_cache import DownloadCache, youtube_video_id
+from .downloader import download_file
 
 from moviepy.editor import *
 from moviepy.editor import VideoFileClip, AudioFileClip
 from pytubefix import YouTube
 from moviepy.editor import *
+from concurrent.futures import ThreadPoolExecutor
 import time, os
 
 class Video:
@@ -11,43 +16,109 @@ class Video:
         self.config = Config.get()
         self.source_ref = source_ref
         self.video_text = video_text
+        # (start, end) of the source kept by crop, in seconds.
+        self._trim = None
+        # Shared lock on the download cache entry used as source, held as long as the video exists.
+        self._source_lock = None
+        self._clip = None
 
         self.source_ref = self.downloadIfYoutubeURL()
         while not os.path.isfile(self.source_ref):
             time.sleep(1)
 
-        self.clip = VideoFileClip(self.source_ref)
+        # Header metadata only, frames are decoded once `clip` is used.
+        self.info = probe(self.source_ref)
+
+
+    @property
+    def clip(self):
+        """MoviePy clip of the video, the source is only opened the first time it is needed."""
+        if self._clip is None:
+            self._clip = VideoFileClip(self.source_ref)
+            if self._trim:
+                self._clip = self._clip.subclip(t_start=self._trim[0], t_end=self._trim[1])
+        return self._clip
+
+    @clip.setter
+    def clip(self, clip):
+        self._clip = clip
 
 
     def crop(self, start_time, end_time, saveFile=False):
-        if end_time > self.clip.duration:
-            end_time = self.clip.duration
+        if self._trim:
+            duration = self._trim[1] - self._trim[0]
+        else:
+            duration = self.info.duration if self.info and self.info.duration else self.clip.duration
+        if end_time > duration:
+            end_time = duration
         save_path = os.path.join(os.getcwd(), self.config.videos_dir, "processed") + ".mp4"
-        self.clip = self.clip.subclip(t_start=start_time, t_end=end_time)
-        if saveFile:
+        # Only recorded, the cut is applied when the video is rendered or its clip is opened.
+        if self._clip is not None:
+            self._clip = self._clip.subclip(t_start=start_time, t_end=end_time)
+        offset = self._trim[0] if self._trim else 0
+        self._trim = (offset + start_time, offset + end_time)
+        if saveFile and not trim(self.source_ref, save_path, *self._trim, preset=self.config.render_preset, crf=self.config.render_crf):
+            print("Could not trim video with ffmpeg, re-encoding with MoviePy...")
             self.clip.write_videofile(save_path)
-        return self.clip
+        return self
 
 
-    def createVideo(self):
+    def createVideo(self, output_path=None):
+        """Renders the TikTok video to `output_path`, post-processed.mp4 in POST_PROCESSING_VIDEO_PATH by default,
+        and returns its path. Nothing is decoded here, open the file when its frames are needed."""
+        if not self.video_text and self._trim is None and self.info and self.info.is_tiktok_ready:
+            print("Video already meets TikTok's requirements, skipping rendering")
+            return self.source_ref
+        if self.config.render_engine == "ffmpeg":
+            rendered = self._render_ffmpeg(output_path)
+            if rendered:
+                return rendered
+            print("Could not render video with ffmpeg, rendering with MoviePy...")
+
         self.clip = self.clip.resize(width=1080)
         base_clip = ColorClip(size=(1080, 1920), color=[10, 10, 10], duration=self.clip.duration)
         bottom_meme_pos = 960 + (((1080 / self.clip.size[0]) * (self.clip.size[1])) / 2) + -20
         if self.video_text:
-            try:
-                meme_overlay = TextClip(txt=self.video_text, bg_color=self.config.imagemagick_text_background_color, color=self.config.imagemagick_text_foreground_color, size=(900, None), kerning=-1,
-                            method="caption", font=self.config.imagemagick_font, fontsize=self.config.imagemagick_font_size, align="center")
-            except OSError as e:
-                print("Please make sure that ImageMagick is installed on your computer")
-                print(e)
-                exit()
+            meme_overlay = ImageClip(self._caption_image())
             meme_overlay = meme_overlay.set_duration(self.clip.duration)
             self.clip = CompositeVideoClip([base_clip, self.clip.set_position(("center", "center")),
                                             meme_overlay.set_position(("center", bottom_meme_pos))])
 
-        dir = os.path.join(self.config.post_processing_video_path, "post-processed")+".mp4"
-        self.clip.write_videofile(dir, fps=24)
-        return dir, self.clip
+        dir = output_path or os.path.join(self.config.post_processing_video_path, "post-processed")+".mp4"
+        self.clip.write_videofile(dir, fps=24, threads=self.config.render_threads or None, preset=self.config.render_preset,
+                                  ffmpeg_params=["-crf", str(self.config.render_crf)])
+        return dir
+
+
+    def _render_ffmpeg(self, output_path=None):
+        """Same output as the MoviePy path, rendered by ffmpeg in a single pass without decoding frames in Python."""
+        stream = self.render_stream(output_path, self.config.render_output)
+        if not stream or not stream.wait():
+            return None
+        return stream.output_path
+
+
+    def render_stream(self, output_path=None, output="fragmented"):
+        """Starts the ffmpeg render in the background and returns its RenderStream, by default a fragmented
+        .mp4 whose completed byte ranges can be read while it is encoded. None if the source can't be probed."""
+        if not self.info or not self.info.width:
+            return None
+        bottom_meme_pos = 960 + (((1080 / self.info.width) * (self.info.height)) / 2) + -20
+        caption_path = self._caption_image() if self.video_text else None
+
+        dir = output_path or os.path.join(self.config.post_processing_video_path, "post-processed")+".mp4"
+        return render_stream(self.source_ref, dir, 1080, 1920, "0x0a0a0a", caption_path, bottom_meme_pos, self._trim, fps=24,
+                             threads=self.config.render_threads, preset=self.config.render_preset, crf=self.config.render_crf, output=output)
+
+
+    def _caption_image(self):
+        try:
+            return caption_image(self.video_text, self.config.imagemagick_font, self.config.imagemagick_font_size,
+                                 self.config.imagemagick_text_foreground_color, self.config.imagemagick_text_background_color)
+        except OSError as e:
+            print("Please make sure that ImageMagick is installed on your computer")
+            print(e)
+            exit()
 
 
     def is_valid_file_format(self):
@@ -56,34 +127,72 @@ class Video:
 
 
     def get_youtube_video(self, max_res=True):
+        video_path, self._source_lock = DownloadCache.get().fetch(self.source_ref, Video._DOWNLOAD_PARAMS, self._download_youtube_video)
+        return video_path
+
+    def _download_youtube_video(self, output_dir):
         url = self.source_ref
-        video = YouTube(url,use_po_token=True).streams.filter(file_extension="mp4", adaptive=True).first()
-        audio = YouTube(url,use_po_token=True).streams.filter(file_extension="webm", only_audio=True, adaptive=True).first()
+        # One metadata fetch for both streams, the watch page and player are only loaded once.
+        streams = YouTube(url, use_po_token=True).streams
+        video = streams.filter(file_extension="mp4", adaptive=True).first()
+        audio = streams.filter(file_extension="webm", only_audio=True, adaptive=True).first()
         if video and audio:
             random_filename = str(int(time.time()))
-            video_path = os.path.join(os.getcwd(), Config.get().videos_dir, "pre-processed.mp4")
+            video_path = os.path.join(output_dir, "pre-processed.mp4")
             resolution = int(video.resolution[:-1])
             if resolution >= 360:
-                downloaded_v_path = video.download(output_path=os.path.join(os.getcwd(), self.config.videos_dir), filename=random_filename)
-                downloaded_a_path = audio.download(output_path=os.path.join(os.getcwd(), self.config.videos_dir), filename="a" + random_filename)
-                file_check_iter = 0
-                while not os.path.exists(downloaded_a_path) and os.path.exists(downloaded_v_path):
-                    time.sleep(2**file_check_iter)
-                    file_check_iter += 1
-                    if file_check_iter > 3:
+                # Both streams are downloaded at the same time, each call returns once its file is written.
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    video_download = executor.submit(self._download_stream, video, output_dir, random_filename)
+                    audio_download = executor.submit(self._download_stream, audio, output_dir, "a" + random_filename)
+                    try:
+                        downloaded_v_path = video_download.result()
+                        downloaded_a_path = audio_download.result()
+                    except Exception as e:
                         print("Error saving these files to directory, please try again")
+                        print(e)
                         return
-                composite_video = VideoFileClip(downloaded_v_path).set_audio(AudioFileClip(downloaded_a_path))
-                composite_video.write_videofile(video_path)
+                if not downloaded_v_path or not downloaded_a_path:
+                    print("Error saving these files to directory, please try again")
+                    return
+                if not mux(downloaded_v_path, downloaded_a_path, video_path):
+                    print("Could not mux streams with ffmpeg, re-encoding with MoviePy...")
+                    composite_video = VideoFileClip(downloaded_v_path).set_audio(AudioFileClip(downloaded_a_path))
+                    composite_video.write_videofile(video_path)
                 os.remove(downloaded_a_path)
                 os.remove(downloaded_v_path)
-                return video_path
+                return video_path, {"video": video.itag, "audio": audio.itag}
             else:
                 print("All videos are too low of quality.")
                 return
         print("No videos available with both audio and video available...")
         return False
 
+    def _download_stream(self, stream, output_dir, filename):
+        """Downloads a stream in parallel byte ranges, resuming what a previous run already downloaded."""
+        if not stream.filesize:
+            # Without a known size there are no ranges to split, download it in one go.
+            return stream.download(output_path=output_dir, filename=filename)
+        on_progress = self._download_progress()
+        partial_path = DownloadCache.get().partial_path(f"{youtube_video_id(self.source_ref)}-{stream.itag}")
+        path = download_file(stream.url, stream.filesize, os.path.join(output_dir, filename), partial_path,
+                             lambda bytes_remaining: on_progress(stream, None, bytes_remaining))
+        if path:
+            print(f"Downloaded {stream.type} stream")
+        return path
+
+    @staticmethod
+    def _download_progress():
+        """Progress callback printing each stream's download progress every 10%."""
+        printed = {}
+
+        def on_progress(stream, chunk, bytes_remaining):
+            step = (stream.filesize - bytes_remaining) * 10 // stream.filesize if stream.filesize else 10
+            if printed.get(stream.itag) != step:
+                printed[stream.itag] = step
+                print(f"Downloading {stream.type} stream: {step * 10}%")
+        return on_progress
+
     def downloadIfYoutubeURL(self):
         if any(ext in self.source_ref for ext in Video._YT_DOMAINS):
             print("Detected Youtube Video...")
@@ -91,6 +200,9 @@ class Video:
             return video_dir
         return self.source_ref
 
+    # Stream selection and processing of Youtube sources, part of their download cache key.
+    _DOWNLOAD_PARAMS = {"video": "mp4 adaptive", "audio": "webm audio", "min_resolution": 360, "mux": "mp4 aac"}
+
     _YT_DOMAINS = [
         "http://youtu.be/", "https://youtu.be/", "http://youtube.com/", "https://youtube.com/",
         "https://m.youtube.com/", "http://www.youtube.com/", "https://www.youtube.com/"
@@ -3,4 +3,8 @@ from .cookies import *
 from .Config import *
 from .Video import *
 from .tiktok import *
+from .signer import *
+from .sessions import *
+from .title import *
+from .tiktok_async import *
 from .basics import *
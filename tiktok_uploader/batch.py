@@ -0,0 +1,142 @@
+import collections, csv, json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from tiktok_uploader import tiktok
+from tiktok_uploader.Config import Config
+from tiktok_uploader.Video import Video
+
+
+# Manifest columns, named after the `cli.py upload` flags, and their defaults.
+MANIFEST_COLUMNS = {
+	"user": None,
+	"video": None,
+	"youtube": None,
+	"title": None,
+	"schedule": 0,
+	"comment": 1,
+	"duet": 0,
+	"stitch": 0,
+	"visibility": 0,
+	"brandorganic": 0,
+	"brandcontent": 0,
+	"ailabel": 0,
+	"proxy": "",
+	"allow_duplicate": 0,
+}
+_INT_COLUMNS = ["schedule", "comment", "duet", "stitch", "visibility", "brandorganic", "brandcontent", "ailabel", "allow_duplicate"]
+_FLAG_COLUMNS = ["comment", "duet", "stitch", "allow_duplicate"]
+
+
+def load_manifest(path):
+	"""Reads the rows of a .csv (with header) or .jsonl manifest, empty cells take the column default."""
+	with open(path, "r", newline="", encoding="utf-8") as f:
+		if path.endswith(".csv"):
+			rows = list(csv.DictReader(f))
+		else:
+			rows = [json.loads(line) for line in f if line.strip()]
+	return [{k: v if v not in ("", None) else MANIFEST_COLUMNS.get(k) for k, v in row.items()} for row in rows]
+
+
+def validate_rows(rows):
+	"""Validates every row before anything is uploaded, returns the list of error messages."""
+	errors = []
+	sessions = {}
+	videos_dir = os.path.join(os.getcwd(), Config.get().videos_dir)
+	for i, row in enumerate(rows, start=1):
+		def error(msg):
+			errors.append(f"Row {i}: {msg}")
+
+		unknown = set(row) - set(MANIFEST_COLUMNS)
+		if unknown:
+			error(f"unknown columns {', '.join(sorted(unknown))}")
+		for column, default in MANIFEST_COLUMNS.items():
+			row.setdefault(column, default)
+		try:
+			for column in _INT_COLUMNS:
+				row[column] = int(row[column])
+		except (TypeError, ValueError):
+			error(f"'{column}' must be an integer")
+			continue
+		for column in _FLAG_COLUMNS:
+			if row[column] not in (0, 1):
+				error(f"'{column}' must be 0 or 1")
+
+		if not row["user"]:
+			error("no user")
+		else:
+			if row["user"] not in sessions:
+				sessions[row["user"]] = tiktok.load_session(row["user"])[0]
+			if not sessions[row["user"]]:
+				error(f"user '{row['user']}' is not logged in, use login first")
+		if not row["title"]:
+			error("no title")
+		elif not tiktok.validate_upload(row["title"], row["schedule"], row["visibility"]):
+			error("invalid title, schedule or visibility")
+
+		if bool(row["video"]) == bool(row["youtube"]):
+			error("exactly one of 'video' or 'youtube' is required")
+		elif row["video"] and not os.path.exists(os.path.join(videos_dir, row["video"])):
+			error(f"video '{row['video']}' does not exist")
+		elif row["youtube"] and not any(domain in row["youtube"] for domain in Video._YT_DOMAINS):
+			error(f"'{row['youtube']}' is not a Youtube url")
+	return errors
+
+
+def run_batch(rows, report_path, workers=4, per_account=1):
+	"""Uploads validated `rows` with at most `workers` uploads running and `per_account` per account.
+	Rows wait in one queue per account and are handed to the pool only when their account has a free
+	slot, so a worker never sits blocked on a busy account. Each result is appended to the JSON lines
+	report as soon as its upload is done, results are returned in row order."""
+	queues = {}
+	for index, row in enumerate(rows, start=1):
+		queues.setdefault(row["user"], collections.deque()).append((index, row))
+	results = [None] * len(rows)
+	remaining = [len(rows)]
+	lock = threading.Lock()
+	finished = threading.Event()
+	if not rows:
+		finished.set()
+
+	with open(report_path, "a", encoding="utf-8") as report:
+		def upload(index, row):
+			result = {"row": index, "user": row["user"], "source": row["video"] or row["youtube"], "title": row["title"]}
+			start = time.monotonic()
+			try:
+				video = row["video"]
+				if row["youtube"]:
+					# Downloads go through the download cache, the entry stays locked while `source` exists.
+					source = Video(row["youtube"], row["title"])
+					video = source.source_ref
+				uploaded = tiktok.upload_video(row["user"], video, row["title"], row["schedule"], row["comment"], row["duet"], row["stitch"], row["visibility"], row["brandorganic"], row["brandcontent"], row["ailabel"], row["proxy"], row["allow_duplicate"])
+				# None is a video already sent to the user, refused before anything was sent.
+				result["status"] = "uploaded" if uploaded else "duplicate" if uploaded is None else "failed"
+			except Exception as e:
+				result["status"] = "error"
+				result["error"] = repr(e)
+			result["seconds"] = round(time.monotonic() - start, 2)
+			with lock:
+				report.write(json.dumps(result) + "\n")
+				report.flush()
+			results[index - 1] = result
+
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			def submit_next(user):
+				with lock:
+					if not queues[user]:
+						return
+					index, row = queues[user].popleft()
+				executor.submit(upload, index, row).add_done_callback(lambda future: done(user))
+
+			def done(user):
+				# The account's slot is free, its next row takes it.
+				submit_next(user)
+				with lock:
+					remaining[0] -= 1
+					if remaining[0] == 0:
+						finished.set()
+
+			for user in queues:
+				for _ in range(max(1, per_account)):
+					submit_next(user)
+			# Rows are submitted from the done callbacks, the pool must not shut down before the last one.
+			finished.wait()
+	return results
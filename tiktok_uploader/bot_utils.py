@@ -1,9 +1,16 @@
-import requests, secrets, string, uuid, zlib, json, re, time, subprocess
+import requests, secrets, string, uuid, zlib, json, re, time, subprocess, mmap, random, os, hashlib
+from concurrent.futures import ThreadPoolExecutor
 from requests_auth_aws_sigv4 import AWSSigV4
+from tiktok_uploader.Config import Config
+from tiktok_uploader.store import CacheTable
+from tiktok_uploader.title import compile_title
 
 
 user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 
+# Size of each multipart upload part (5 MiB).
+CHUNK_SIZE = 5242880
+
 
 def subprocess_jsvmp(js, user_agent, url):
 	proc = subprocess.Popen(['node', js, url, user_agent], stdout=subprocess.PIPE)
@@ -26,6 +33,148 @@ def crc32(content):
 	return ("%X" % (prev & 0xFFFFFFFF)).lower().zfill(8)
 
 
+class VideoPart:
+	"""File-like, zero-copy view over one part of a memory-mapped video.
+	`requests` streams it in small blocks through `read`, so a part is never copied whole."""
+
+	def __init__(self, number, view, crc=None):
+		self.number = number
+		self._view = view
+		self._pos = 0
+		self._crc = crc
+		self._released = False
+
+	def __len__(self):
+		return len(self._view)
+
+	@property
+	def crc(self):
+		if self._crc is None:
+			self._crc = crc32(self._view)
+		return self._crc
+
+	def read(self, size=-1):
+		end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+		block = self._view[self._pos:end].tobytes()
+		self._pos = end
+		return block
+
+	def tell(self):
+		return self._pos
+
+	def seek(self, offset, whence=os.SEEK_SET):
+		if whence == os.SEEK_CUR:
+			offset += self._pos
+		elif whence == os.SEEK_END:
+			offset += len(self._view)
+		self._pos = max(0, min(offset, len(self._view)))
+		return self._pos
+
+	@property
+	def released(self):
+		return self._released
+
+	def release(self):
+		self._view.release()
+		self._released = True
+
+
+class VideoChunks:
+	"""Memory-mapped video file split lazily into upload parts.
+	Pages are only faulted in while a part is hashed or sent, so resident memory stays around
+	`chunk_size * parts in flight` whatever the file size. `crcs` are the part CRCs when already known,
+	e.g. from `stream_crcs`. Use as a context manager."""
+
+	def __init__(self, path, chunk_size=CHUNK_SIZE, crcs=None):
+		self.path = path
+		self.chunk_size = chunk_size
+		self.crcs = crcs
+		self.size = os.path.getsize(path)
+		self._file = None
+		self._map = None
+		self._view = None
+		self._parts = []
+
+	def __enter__(self):
+		self._file = open(self.path, "rb")
+		if self.size:
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+			if hasattr(self._map, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+				self._map.madvise(mmap.MADV_SEQUENTIAL)
+		self._view = memoryview(self._map if self._map is not None else b"")
+		return self
+
+	def __exit__(self, *exc):
+		for part in self._parts:
+			part.release()
+		self._parts = []
+		self._view.release()
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+		self._file.close()
+		self._file = None
+
+	def __len__(self):
+		return (self.size + self.chunk_size - 1) // self.chunk_size
+
+	def digest(self):
+		"""Returns (SHA-256 of the file, CRC32 of each part) computed in one pass over the mapping, the parts
+		then reuse their CRC instead of hashing again."""
+		sha256 = hashlib.sha256()
+		crcs = []
+		for i in range(len(self)):
+			start = i * self.chunk_size
+			with self._view[start:start + self.chunk_size] as view:
+				sha256.update(view)
+				crcs.append(crc32(view))
+		self.crcs = crcs
+		return sha256.hexdigest(), crcs
+
+	def __iter__(self):
+		"""Yields `VideoPart`s in order, parts still alive are released on exit."""
+		for i in range(len(self)):
+			start = i * self.chunk_size
+			part = VideoPart(i + 1, self._view[start:start + self.chunk_size], self.crcs[i] if self.crcs else None)
+			self._parts = [p for p in self._parts if not p.released]
+			self._parts.append(part)
+			yield part
+
+
+def stream_digest(stream, chunk_size=CHUNK_SIZE):
+	"""`VideoChunks.digest` of a fragmented ffmpeg.RenderStream, each part is hashed as soon as the encoder
+	has written it, while its pages are still cached. Returns None if the render failed."""
+	sha256 = hashlib.sha256()
+	crcs = []
+	for start, end in stream.ranges(chunk_size):
+		part = stream.read(start, end)
+		sha256.update(part)
+		crcs.append(crc32(part))
+	return (sha256.hexdigest(), crcs) if stream.wait() else None
+
+
+class Backoff:
+	"""Delays between polling attempts, growing exponentially from `initial` up to `maximum` with jitter.
+	`next_delay` returns None once `max_attempts` attempts were made or the `deadline` (seconds) has passed."""
+
+	def __init__(self, initial=1.0, maximum=15.0, deadline=300.0, max_attempts=40, factor=2.0):
+		self.initial = initial
+		self.maximum = maximum
+		self.max_attempts = max_attempts
+		self.factor = factor
+		self.attempts = 1
+		self._deadline = time.monotonic() + deadline
+
+	def next_delay(self):
+		remaining = self._deadline - time.monotonic()
+		if self.attempts >= self.max_attempts or remaining <= 0:
+			return None
+		base = min(self.maximum, self.initial * self.factor ** (self.attempts - 1))
+		self.attempts += 1
+		# Half fixed, half random, so uploads started together don't poll in lockstep.
+		return min(remaining, base / 2 + random.uniform(0, base / 2))
+
+
 def print_response(r):
 	print(f"{r.status_code}")
 	print(f"{r.content}")
@@ -42,48 +191,75 @@ def assert_success(url, r):
 	return r.status_code == 200
 
 
-def convert_tags(text, session):
-	end = 0
-	i = -1
-	text_extra = []
+def convert_tags(text, session, user_ids=None):
+	"""Returns the markup text and text extra of a title. The user ids of its mentions are resolved
+	with `session` beforehand, unless given in `user_ids`."""
+	compiled = compile_title(text)
+	if user_ids is None:
+		user_ids = resolve_mentions(compiled.mentions, session)
+	return compiled.markup_text, compiled.with_user_ids(user_ids)
+
+
+def find_mentions(text):
+	return list(dict.fromkeys(re.findall(r'@([\w.-]+)', text)))
+
+
+def mention_headers():
+	return {
+		'authority': 'www.tiktok.com',
+		'accept': '*/*',
+		'accept-language': 'q=0.9,en-US;q=0.8,en;q=0.7,zh-CN;q=0.6,zh;q=0.5,vi;q=0.4',
+		'user-agent': user_agent
+	}
 
-	def text_extra_block(start, end, type, hashtag_name, user_id, tag_id):
-		return {
-			"end": end,
-			"hashtag_name": hashtag_name,
-			"start": start,
-			"tag_id": tag_id,
-			"type": type,
-			"user_id": user_id
-		}
-
-	def convert(match):
-		nonlocal i, end, text_extra
-		i += 1
-		if match.group(1):
-			text_extra.append(text_extra_block(end, end + len(match.group(1)) + 1, 1, match.group(1), "", str(i)))
-			end += len(match.group(1)) + 1
-			return "<h id=\"" + str(i) + "\">#" + match.group(1) + "</h>"
-		elif match.group(2):
-			url = "https://www.tiktok.com/@" + match.group(2)
-			headers = {
-				'authority': 'www.tiktok.com',
-				'accept': '*/*',
-				'accept-language': 'q=0.9,en-US;q=0.8,en;q=0.7,zh-CN;q=0.6,zh;q=0.5,vi;q=0.4',
-				'user-agent': user_agent
-			}
-
-			r = session.request("GET", url, headers=headers)
-			user_id = r.text.split('webapp.user-detail":{"userInfo":{"user":{"id":"')[1].split('"')[0]
-			text_extra.append(text_extra_block(end, end + len(match.group(2)) + 1, 0, "", user_id, str(i)))
-			end += len(match.group(2)) + 1
-			return "<m id=\"" + str(i) + "\">@" + match.group(2) + "</m>"
-		else:
-			end += len(match.group(3))
-			return match.group(3)
-
-	result = re.sub(r'#(\w+)|@([\w.-]+)|([^#@]+)', convert, text)
-	return result, text_extra
+
+def parse_user_id(profile_html):
+	"""Extracts the user id from a profile page, None if it is not found."""
+	try:
+		return profile_html.split('webapp.user-detail":{"userInfo":{"user":{"id":"')[1].split('"')[0]
+	except IndexError:
+		return None
+
+
+_mention_cache = None
+
+
+def mention_cache():
+	"""Persistent handle -> user id cache."""
+	global _mention_cache
+	if _mention_cache is None:
+		config = Config.get()
+		_mention_cache = CacheTable("mentions", config.mention_cache_ttl, config.mention_cache_size)
+	return _mention_cache
+
+
+def resolve_mentions(handles, session, max_workers=8):
+	"""Returns {handle: user_id} for `handles`. Cached ids are used first, the remaining profile
+	pages are fetched concurrently and their ids cached. Unresolved handles are left out."""
+	def fetch(handle):
+		url = "https://www.tiktok.com/@" + handle
+		r = session.request("GET", url, headers=mention_headers())
+		return parse_user_id(r.text) if r.status_code == 200 else None
+
+	user_ids, missing = cached_lookup(mention_cache(), handles, fetch, max_workers)
+	for handle in missing:
+		print(f"[-] Could not find user id of @{handle}")
+	return user_ids
+
+
+def cached_lookup(cache, keys, fetch, max_workers=8):
+	"""Looks `keys` up in `cache`, calling `fetch(key)` concurrently for the missing ones.
+	Fetched values are cached unless None. Returns ({key: value}, [keys that could not be fetched])."""
+	values = cache.get_many(keys)
+	missing = [key for key in dict.fromkeys(keys) if key not in values]
+	if not missing:
+		return values, []
+	with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+		fetched = dict(zip(missing, executor.map(fetch, missing)))
+	found = {key: value for key, value in fetched.items() if value is not None}
+	cache.set_many(found)
+	values.update(found)
+	return values, [key for key, value in fetched.items() if value is None]
 
 
 def printResponse(r):
@@ -102,34 +278,69 @@ def assertSuccess(url, r):
 	return r.status_code == 200
 
 
-def getTagsExtra(title, tags, users, session):
-	text_extra = []
-	for tag in tags:
+_tag_caches = {}
+
+
+def tag_cache(name):
+	"""Persistent cache of verified hashtags ("tags") or users ("users")."""
+	if name not in _tag_caches:
+		config = Config.get()
+		_tag_caches[name] = CacheTable(name, config.tag_cache_ttl, config.tag_cache_size)
+	return _tag_caches[name]
+
+
+def verify_tags(tags, session):
+	"""Returns {tag: verified tag name}, tags without suggestion keep their name. False if a request failed."""
+	def fetch(tag):
 		url = "https://www.tiktok.com/api/upload/challenge/sug/"
 		params = {"keyword": tag}
 		r = session.get(url, params=params)
 		if not assertSuccess(url, r):
-			return False
+			return None
 		try:
-			verified_tag = r.json()["sug_list"][0]["cha_name"]
+			return r.json()["sug_list"][0]["cha_name"]
 		except:
-			verified_tag = tag
-		title += " #"+verified_tag
-		text_extra.append({"start": len(title)-len(verified_tag)-1, "end": len(
-			title), "user_id": "", "type": 1, "hashtag_name": verified_tag})
-	for user in users:
+			return tag
+
+	verified, failed = cached_lookup(tag_cache("tags"), tags, fetch)
+	return False if failed else verified
+
+
+def verify_users(users, session):
+	"""Returns {user: [unique id, user id]}, unknown users keep their name and an empty id. False if a request failed."""
+	def fetch(user):
 		url = "https://us.tiktok.com/api/upload/search/user/"
 		params = {"keyword": user}
 		r = session.get(url, params=params)
 		if not assertSuccess(url, r):
-			return False
+			return None
 		try:
-			verified_user = r.json()["user_list"][0]["user_info"]["unique_id"]
-			verified_user_id = r.json()["user_list"][0]["user_info"]["uid"]
+			return [r.json()["user_list"][0]["user_info"]["unique_id"], r.json()["user_list"][0]["user_info"]["uid"]]
 		except:
-			verified_user = user
-			verified_user_id = ""
-		title += " @"+verified_user
-		text_extra.append({"start": len(title)-len(verified_user)-1, "end": len(
-			title), "user_id": verified_user_id, "type": 0, "hashtag_name": verified_user})
-	return title, text_extra
+			return [user, ""]
+
+	verified, failed = cached_lookup(tag_cache("users"), users, fetch)
+	return False if failed else verified
+
+
+def getTagsExtra(title, tags, users, session):
+	verified_tags = verify_tags(tags, session)
+	verified_users = verify_users(users, session) if verified_tags is not False else False
+	if verified_tags is False or verified_users is False:
+		return False
+
+	# Offsets are tracked while appending, the title is joined once.
+	parts = [title]
+	length = len(title)
+	text_extra = []
+	for tag in tags:
+		verified_tag = verified_tags[tag]
+		parts.append(" #" + verified_tag)
+		length += len(verified_tag) + 2
+		text_extra.append({"start": length-len(verified_tag)-1, "end": length, "user_id": "", "type": 1, "hashtag_name": verified_tag})
+	for user in users:
+		verified_user, verified_user_id = verified_users[user]
+		parts.append(" @" + verified_user)
+		length += len(verified_user) + 2
+		text_extra.append({"start": length-len(verified_user)-1, "end": length, "user_id": verified_user_id, "type": 0, "hashtag_name": verified_user})
+	return "".join(parts), text_extra
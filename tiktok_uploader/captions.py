@@ -0,0 +1,61 @@
+import hashlib, json, os
+from moviepy.editor import TextClip
+from .Config import Config
+
+
+def caption_key(text, font, font_size, color, bg_color, width):
+    """Content address of a rendered caption, the same text and style always give the same key."""
+    style = json.dumps([text, font, font_size, color, bg_color, width], ensure_ascii=False)
+    return hashlib.sha256(style.encode("utf-8")).hexdigest()
+
+
+def caption_dir():
+    path = os.path.join(os.getcwd(), Config.get().cache_dir, "captions")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def caption_image(text, font, font_size, color, bg_color, width=900):
+    """Returns the path of the caption rendered as a PNG, ImageMagick only runs when it is not cached yet.
+    Raises OSError if ImageMagick is not available."""
+    directory = caption_dir()
+    path = os.path.join(directory, caption_key(text, font, font_size, color, bg_color, width) + ".png")
+    try:
+        # The modification time orders the eviction, least recently used first.
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+
+    clip = TextClip(txt=text, bg_color=bg_color, color=color, size=(width, None), kerning=-1,
+                    method="caption", font=font, fontsize=font_size, align="center")
+    # Written aside and moved in place, other processes never see a partial image.
+    tmp_path = os.path.join(directory, f".{os.path.basename(path)[:-4]}-{os.getpid()}.png")
+    clip.save_frame(tmp_path)
+    clip.close()
+    os.replace(tmp_path, path)
+    evict_captions(directory, Config.get().caption_cache_size, keep=path)
+    return path
+
+
+def evict_captions(directory, max_bytes, keep=None):
+    """Removes the least recently used captions, except `keep`, until the cache is at most `max_bytes`."""
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".png") and not entry.name.startswith("."):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -0,0 +1,163 @@
+import fcntl, hashlib, json, os, shutil, tempfile, threading, time
+from urllib.parse import urlparse, parse_qs
+from .Config import Config
+
+
+def youtube_video_id(url):
+    """Id of a Youtube video from its watch, youtu.be, shorts, embed or live url, None if there is none."""
+    parsed = urlparse(url)
+    if parsed.netloc.endswith("youtu.be"):
+        return parsed.path.strip("/").split("/")[0] or None
+    if "v" in parse_qs(parsed.query):
+        return parse_qs(parsed.query)["v"][0]
+    parts = parsed.path.strip("/").split("/")
+    if len(parts) >= 2 and parts[0] in ("shorts", "embed", "live", "v"):
+        return parts[1]
+    return None
+
+
+class DownloadCache:
+    """Downloaded Youtube sources in CACHE_DIR/downloads, keyed by video id and the parameters used to
+    select and process the streams. Each entry is `<key>.mp4` with a `<key>.json` sidecar recording
+    the url and stream itags. `<key>.lock` is locked shared by users of the entry and exclusively while it
+    is evicted. A miss takes `<key>.dl` exclusively while it downloads, so concurrent runs wait for one
+    download instead of clobbering it, and stop waiting as soon as it is done."""
+    __instance = None
+    __lock = threading.Lock()
+
+    @staticmethod
+    def get():
+        if DownloadCache.__instance is None:
+            with DownloadCache.__lock:
+                if DownloadCache.__instance is None:
+                    DownloadCache.__instance = DownloadCache()
+        return DownloadCache.__instance
+
+    def __init__(self, directory=None, max_bytes=None, max_age=None):
+        config = Config.get()
+        self.directory = directory or os.path.join(os.getcwd(), config.cache_dir, "downloads")
+        self.max_bytes = max_bytes if max_bytes is not None else config.download_cache_max_bytes
+        self.max_age = max_age if max_age is not None else config.download_cache_max_age
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, url, params):
+        video_id = youtube_video_id(url) or hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        params = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        return f"{video_id}-{params}"
+
+    def fetch(self, url, params, download):
+        """Returns (path, lock) of the cached source of `url`, or (None, None) if it could not be downloaded.
+        On a miss `download(tmp_dir)` is called and returns (path of the file it wrote in tmp_dir, itags)
+        or a falsy value. `lock` holds the entry shared, keep it open while the file is used."""
+        key = self.key(url, params)
+        path = os.path.join(self.directory, key + ".mp4")
+        lock = self._lock(path[:-4] + ".lock", fcntl.LOCK_SH)
+        try:
+            if self._hit(path):
+                return path, lock
+            # Only one process downloads, the others find the entry once they get the download lock. The
+            # shared lock is kept meanwhile, the entry can't be evicted before it is returned.
+            with self._lock(path[:-4] + ".dl", fcntl.LOCK_EX) as download_lock:
+                try:
+                    downloaded = self._hit(path) or self._download(url, key, path, download)
+                finally:
+                    # Unlinked while still held, the waiters take it again on a new file and find the entry.
+                    os.remove(download_lock.name)
+            if not downloaded:
+                lock.close()
+                return None, None
+        except BaseException:
+            lock.close()
+            raise
+        self.evict()
+        return path, lock
+
+    def partial_path(self, name):
+        """Path where a download in progress is kept until it is complete, it survives failed runs so they can be resumed."""
+        directory = os.path.join(self.directory, ".partial")
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    def _hit(self, path):
+        try:
+            # The modification time orders the eviction, least recently used first.
+            os.utime(path)
+            return os.path.exists(path[:-4] + ".json")
+        except FileNotFoundError:
+            return False
+
+    def _download(self, url, key, path, download):
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            result = download(tmp_dir)
+            if not result:
+                return False
+            file, itags = result
+            sidecar = os.path.join(tmp_dir, key + ".json")
+            with open(sidecar, "w") as f:
+                json.dump({"url": url, "video_id": youtube_video_id(url), "itags": itags, "size": os.path.getsize(file), "created": time.time()}, f)
+            # The video is moved first, an entry only counts once its sidecar exists.
+            os.replace(file, path)
+            os.replace(sidecar, path[:-4] + ".json")
+            return True
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def evict(self):
+        """Removes entries unused for more than `max_age` seconds, then the least recently used ones
+        until the cache is at most `max_bytes`. Entries in use are skipped."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".mp4"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                break
+            if self._remove(path):
+                total -= size
+        # Downloads that were never resumed.
+        partial_dir = os.path.join(self.directory, ".partial")
+        if os.path.isdir(partial_dir):
+            for entry in os.scandir(partial_dir):
+                try:
+                    if now - entry.stat().st_mtime > self.max_age:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def _lock(self, lock_path, operation):
+        """Opens and flocks `lock_path`. Evictions unlink the lock file while holding it, so a lock taken
+        on a file that was unlinked meanwhile is dropped and taken again on the current one."""
+        while True:
+            lock = open(lock_path, "a")
+            try:
+                fcntl.flock(lock, operation)
+                try:
+                    if os.path.samestat(os.fstat(lock.fileno()), os.stat(lock_path)):
+                        return lock
+                except FileNotFoundError:
+                    pass
+            except BaseException:
+                lock.close()
+                raise
+            lock.close()
+
+    def _remove(self, path):
+        try:
+            lock = self._lock(path[:-4] + ".lock", fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        with lock:
+            # The lock file goes last, while it is still held.
+            for file in (path[:-4] + ".json", path, path[:-4] + ".lock"):
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+        return True
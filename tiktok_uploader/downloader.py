@@ -0,0 +1,115 @@
+import json, os, threading, time, zlib
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from .Config import Config
+
+
+def download_file(url, size, path, partial_path, on_progress=None):
+    """Downloads `size` bytes from `url` to `path` as byte range segments fetched in parallel.
+    The file is written at `partial_path` and its finished segments are recorded, with their CRC32,
+    in `partial_path`.json, so a later call resumes from what is already on disk and only fetches the
+    missing ranges. A segment is only finished if it has the exact expected size. The file is only
+    moved to `path` once every segment is, returns `path` or None if some segments could not be downloaded.
+    `on_progress(bytes_remaining)` is called as data is written."""
+    config = Config.get()
+    segment_size = config.download_segment_size
+    segments = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+    crcs = _resume(partial_path, size, segment_size)
+    state_lock = threading.Lock()
+    remaining = size - sum(end - start + 1 for i, (start, end) in enumerate(segments) if str(i) in crcs)
+
+    def progress(written):
+        nonlocal remaining
+        with state_lock:
+            remaining -= written
+            if on_progress:
+                on_progress(remaining)
+
+    def fetch(index):
+        start, end = segments[index]
+        crc = _download_segment(session, url, partial_path, start, end, config.download_retries, progress)
+        if crc is None:
+            return False
+        with state_lock:
+            crcs[str(index)] = crc
+            _save_state(partial_path, size, segment_size, crcs)
+        return True
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(1, config.download_concurrency))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"})
+    with session, ThreadPoolExecutor(max_workers=max(1, config.download_concurrency)) as executor:
+        results = list(executor.map(fetch, [i for i in range(len(segments)) if str(i) not in crcs]))
+
+    if not all(results):
+        print(f"[-] Could not download {sum(not r for r in results)} segments of {os.path.basename(path)}, run again to resume")
+        return None
+    if os.path.getsize(partial_path) != size:
+        print(f"[-] Downloaded file has {os.path.getsize(partial_path)} bytes instead of {size}")
+        return None
+    os.replace(partial_path, path)
+    os.remove(partial_path + ".json")
+    return path
+
+
+def _resume(partial_path, size, segment_size):
+    """Returns the CRC32 of the segments already in the partial file ({index: crc}), after checking
+    them against the file. Starts a new partial file of `size` bytes if there is none to resume."""
+    try:
+        with open(partial_path + ".json", "r") as f:
+            state = json.load(f)
+        if state["size"] != size or state["segment_size"] != segment_size or os.path.getsize(partial_path) != size:
+            raise ValueError("partial download of another file")
+    except (OSError, ValueError, KeyError):
+        with open(partial_path, "wb") as f:
+            f.truncate(size)
+        _save_state(partial_path, size, segment_size, {})
+        return {}
+
+    crcs = {}
+    with open(partial_path, "rb") as f:
+        for index, crc in state["crcs"].items():
+            f.seek(int(index) * segment_size)
+            if zlib.crc32(f.read(min(segment_size, size - int(index) * segment_size))) == crc:
+                crcs[index] = crc
+    print(f"Resuming download, {len(crcs)} segments already downloaded")
+    return crcs
+
+
+def _save_state(partial_path, size, segment_size, crcs):
+    tmp_path = partial_path + ".json.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"size": size, "segment_size": segment_size, "crcs": crcs}, f)
+    os.replace(tmp_path, partial_path + ".json")
+
+
+def _download_segment(session, url, path, start, end, retries, progress):
+    """Writes bytes `start` to `end` (inclusive) of `url` at the same offsets of `path`, returns their CRC32 or None."""
+    for attempt in range(retries + 1):
+        if attempt:
+            print(f"[-] Retrying bytes {start}-{end} ({attempt}/{retries})")
+            time.sleep(min(2 ** attempt, 10))
+        crc = 0
+        written = 0
+        try:
+            with session.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=30) as r:
+                if r.status_code != 206:
+                    print(f"[-] Range request for bytes {start}-{end} returned {r.status_code}")
+                    continue
+                with open(path, "r+b") as f:
+                    f.seek(start)
+                    for block in r.iter_content(65536):
+                        f.write(block)
+                        crc = zlib.crc32(block, crc)
+                        written += len(block)
+                        progress(len(block))
+            if written == end - start + 1:
+                return crc
+            print(f"[-] Got {written} bytes for bytes {start}-{end}")
+        except requests.RequestException as e:
+            print(f"[-] Bytes {start}-{end} failed: {e}")
+        # The segment is downloaded again from its start.
+        progress(-written)
+    return None
@@ -0,0 +1,87 @@
+import multiprocessing, os, threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .Config import Config
+from .Video import Video
+from .batch import load_manifest
+
+
+# Render manifest columns and their defaults, a row has a `video` in VIDEOS_DIR or a `youtube` url.
+RENDER_COLUMNS = {
+    "video": None,
+    "youtube": None,
+    "text": "",
+    "start": None,
+    "end": None,
+}
+
+
+def load_jobs(path):
+    """Reads the rows of a .csv or .jsonl render manifest, empty cells take the column default."""
+    return [{**RENDER_COLUMNS, **{k: v for k, v in row.items() if v is not None}} for row in load_manifest(path)]
+
+
+def preprocess(jobs, download_workers=4, render_workers=None, max_ready=None):
+    """Downloads and renders every job. Sources are fetched on a thread pool and rendered on a process
+    pool with one worker per core by default. At most `max_ready` fetched sources (default one per render
+    worker) wait for an encoder, further downloads wait for a render to finish, so the encoders always
+    have their next source ready without downloads running ahead of them. Unless RENDER_THREADS is set, the
+    cores are split between the workers' encoders. Returns one result per job, in order."""
+    render_workers = render_workers or os.cpu_count() or 1
+    render_threads = Config.get().render_threads or max(1, (os.cpu_count() or 1) // render_workers)
+    max_ready = render_workers if max_ready is None else max_ready
+    slots = threading.Semaphore(render_workers + max_ready)
+    results = [None] * len(jobs)
+    videos_dir = os.path.join(os.getcwd(), Config.get().videos_dir)
+    output_dir = os.path.join(os.getcwd(), Config.get().post_processing_video_path)
+
+    # Spawned, forking while the download threads run could deadlock the workers.
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=render_workers, mp_context=spawn, initializer=_init_renderer, initargs=(Config.get().path, render_threads)) as renderers, \
+            ThreadPoolExecutor(max_workers=download_workers) as fetchers:
+        def fetch(index, job):
+            result = results[index] = {"job": index + 1, "source": job["youtube"] or job["video"]}
+            try:
+                if bool(job["video"]) == bool(job["youtube"]):
+                    raise ValueError("exactly one of 'video' or 'youtube' is required")
+                if job["video"] and not os.path.isfile(os.path.join(videos_dir, job["video"])):
+                    # Video waits for local files to appear.
+                    raise FileNotFoundError(f"video '{job['video']}' does not exist")
+                # Youtube sources go through the download cache, `video` keeps the entry locked.
+                video = Video(job["youtube"] or os.path.join(videos_dir, job["video"]), job["text"])
+                output_path = os.path.join(output_dir, f"post-processed-{index + 1}.mp4")
+                render = renderers.submit(_render, video.source_ref, job["text"], job["start"], job["end"], output_path)
+            except BaseException as e:
+                # Video exits on unusable sources, the slot must be released whatever happened.
+                result.update(status="error", error=repr(e))
+                slots.release()
+                return
+
+            def rendered(render):
+                try:
+                    result.update(status="rendered", output=render.result())
+                except BaseException as e:
+                    result.update(status="error", error=repr(e))
+                finally:
+                    if video._source_lock:
+                        video._source_lock.close()
+                    slots.release()
+            render.add_done_callback(rendered)
+
+        for index, job in enumerate(jobs):
+            slots.acquire()
+            fetchers.submit(fetch, index, job)
+    return results
+
+
+def _init_renderer(config_path, render_threads):
+    # Workers start without the loaded config, unless importing the main module loaded it.
+    if config_path and Config._instance is None:
+        Config.load(config_path)
+    Config.get()._insert_option("RENDER_THREADS", render_threads)
+
+
+def _render(source_path, video_text, start, end, output_path):
+    video = Video(source_path, video_text)
+    if start is not None or end is not None:
+        video.crop(float(start or 0), float(end) if end is not None else float("inf"))
+    return video.createVideo(output_path)
@@ -0,0 +1,315 @@
+import os, re, subprocess, tempfile, time
+from imageio_ffmpeg import get_ffmpeg_exe
+
+
+# Codecs that can be copied into an .mp4 uploaded to TikTok without re-encoding.
+MP4_VIDEO_CODECS = ["h264", "hevc"]
+MP4_AUDIO_CODECS = ["aac", "mp3"]
+
+# What TikTok plays as it is, a file meeting all of it is uploaded without being transcoded.
+TIKTOK_CONTAINERS = ["mov", "mp4"]
+TIKTOK_PIXEL_FORMATS = ["yuv420p", "yuvj420p"]
+TIKTOK_SIZE = (1080, 1920)
+TIKTOK_MAX_DURATION = 600
+
+# Muxer flags of rendered files. A fast-start file gets its index moved to the front once the encode is
+# done, a fragmented one starts with an empty index followed by self-contained fragments, so it only grows.
+MOVFLAGS = {
+    "faststart": "+faststart",
+    "fragmented": "+frag_keyframe+empty_moov+default_base_moof",
+}
+
+_INPUT = re.compile(r"^Input #0, (.+?), from ", re.M)
+_DURATION = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
+_BITRATE = re.compile(r"bitrate: (\d+) kb/s")
+_STREAM = re.compile(r"^\s*Stream #\d+:\d+.*?: (Video|Audio): (\w+)(.*)$", re.M)
+_PIXEL_FORMAT = re.compile(r"^[^,]*?, (\w+)")
+_RESOLUTION = re.compile(r", (\d{2,5})x(\d{2,5})")
+_FPS = re.compile(r", ([\d.]+) fps")
+_ROTATION = re.compile(r"displaymatrix: rotation of (-?[\d.]+) degrees")
+_PTS_TIME = re.compile(r"pts_time:(-?[\d.]+)")
+_FRAMECRC_TB = re.compile(r"^#tb 0: (\d+)/(\d+)", re.M)
+_FRAMECRC_PTS = re.compile(r"^0,\s*-?\d+,\s*(-?\d+),", re.M)
+# Cut points closer than this to a keyframe are considered on it, in seconds.
+_KEYFRAME_TOLERANCE = 0.001
+
+
+def ffmpeg_binary():
+    """Path of the ffmpeg binary MoviePy uses (bundled by imageio-ffmpeg), None if unavailable."""
+    try:
+        return get_ffmpeg_exe()
+    except RuntimeError:
+        return None
+
+
+class MediaInfo:
+    """Container, codecs, resolution, duration and bitrate of a media file, read from its headers.
+    Values ffmpeg does not report are None, `width` and `height` are the displayed ones (rotation applied)."""
+
+    def __init__(self, path, container=None, duration=None, bitrate=None, video_codec=None, pixel_format=None, width=None, height=None, fps=None, audio_codec=None):
+        self.path = path
+        self.container = container
+        self.duration = duration
+        self.bitrate = bitrate
+        self.video_codec = video_codec
+        self.pixel_format = pixel_format
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.audio_codec = audio_codec
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def is_tiktok_ready(self):
+        """Whether TikTok takes the file as it is: no crop, resize or re-encode needed."""
+        return (any(name in TIKTOK_CONTAINERS for name in (self.container or "").split(","))
+                and self.video_codec in MP4_VIDEO_CODECS and self.pixel_format in TIKTOK_PIXEL_FORMATS
+                and self.audio_codec in MP4_AUDIO_CODECS + [None] and self.size == TIKTOK_SIZE
+                and self.duration is not None and self.duration <= TIKTOK_MAX_DURATION)
+
+
+def probe(path):
+    """Reads the MediaInfo of a file from the header metadata ffmpeg prints, no frame is decoded.
+    Returns None if ffmpeg is unavailable or the file can't be read."""
+    binary = ffmpeg_binary()
+    if not binary or not os.path.isfile(path):
+        return None
+    # Without an output ffmpeg exits with an error, the input info is still printed on stderr.
+    output = subprocess.run([binary, "-hide_banner", "-i", path], capture_output=True, text=True, errors="replace").stderr
+    container = _INPUT.search(output)
+    if not container:
+        return None
+    info = MediaInfo(path, container=container.group(1))
+    duration = _DURATION.search(output)
+    if duration:
+        info.duration = int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+    bitrate = _BITRATE.search(output)
+    if bitrate:
+        info.bitrate = int(bitrate.group(1))
+    for kind, codec, details in _STREAM.findall(output):
+        if kind == "Audio" and info.audio_codec is None:
+            info.audio_codec = codec
+        elif kind == "Video" and info.video_codec is None:
+            info.video_codec = codec
+            # Drop the codec profile, e.g. "(High) (avc1 / 0x31637661)", before reading the pixel format.
+            pixel_format = _PIXEL_FORMAT.search(re.sub(r"\([^()]*\)", "", details))
+            info.pixel_format = pixel_format.group(1) if pixel_format else None
+            resolution = _RESOLUTION.search(details)
+            if resolution:
+                info.width, info.height = int(resolution.group(1)), int(resolution.group(2))
+            fps = _FPS.search(details)
+            if fps:
+                info.fps = float(fps.group(1))
+    rotation = _ROTATION.search(output)
+    if rotation and info.width and round(abs(float(rotation.group(1)))) % 180 == 90:
+        info.width, info.height = info.height, info.width
+    return info
+
+
+def mux(video_path, audio_path, output_path):
+    """Muxes a video only and an audio only file into an .mp4 without decoding the video: its stream is
+    copied, the audio is only transcoded to AAC when it can't go in an .mp4 as it is (e.g. opus from webm).
+    Returns False, leaving `output_path` untouched, when ffmpeg is unavailable or the video must be re-encoded."""
+    binary = ffmpeg_binary()
+    if not binary:
+        return False
+    video, audio = probe(video_path), probe(audio_path)
+    if not video or not audio or video.video_codec not in MP4_VIDEO_CODECS or not audio.audio_codec:
+        return False
+
+    command = [binary, "-y", "-hide_banner", "-loglevel", "error", "-i", video_path, "-i", audio_path,
+               "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy"]
+    command += ["-c:a", "copy"] if audio.audio_codec in MP4_AUDIO_CODECS else ["-c:a", "aac", "-b:a", "192k"]
+    # Index at the start of the file, TikTok can start processing before the whole file is read.
+    command += ["-movflags", "+faststart"]
+    return _write_mp4(command, output_path, f"mux {video_path} and {audio_path}")
+
+
+def render(source_path, output_path, width, height, background, caption_path=None, caption_y=0, trim=None, fps=24, threads=0, preset="medium", crf=23, output="faststart"):
+    """Renders `source_path` letterboxed in a `width`x`height` frame in one encoder pass: the scale, crop,
+    pad and caption overlay run as a single filter graph. The source is scaled to `width`, cropped to
+    `height` if taller, centered on a `background` ("0xRRGGBB") frame, and the caption image is overlaid
+    horizontally centered at `caption_y`. `trim` is an optional (start, end) in seconds, `output` one of
+    MOVFLAGS. Returns True on success."""
+    stream = render_stream(source_path, output_path, width, height, background, caption_path, caption_y, trim, fps, threads, preset, crf, output)
+    return bool(stream) and stream.wait()
+
+
+def render_stream(source_path, output_path, width, height, background, caption_path=None, caption_y=0, trim=None, fps=24, threads=0, preset="medium", crf=23, output="fragmented"):
+    """Starts the same render as `render` in the background and returns its RenderStream, None if ffmpeg is unavailable."""
+    binary = ffmpeg_binary()
+    if not binary:
+        return None
+    command = [binary, "-y", "-hide_banner", "-loglevel", "error"]
+    if trim:
+        command += ["-ss", str(trim[0]), "-to", str(trim[1])]
+    command += ["-i", source_path]
+    graph = f"[0:v]scale={width}:-2,crop={width}:'min(ih,{height})',pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color={background},fps={fps},setsar=1"
+    if caption_path:
+        command += ["-i", caption_path]
+        graph += f"[bg];[bg][1:v]overlay=(W-w)/2:{int(caption_y)}:format=auto"
+    graph += ",format=yuv420p[out]"
+    command += ["-filter_complex", graph, "-map", "[out]", "-map", "0:a?",
+                "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-threads", str(threads),
+                "-c:a", "aac", "-b:a", "192k", "-movflags", MOVFLAGS[output]]
+    return RenderStream(command, output_path, f"render {source_path}", output)
+
+
+class RenderStream:
+    """ffmpeg writing an .mp4 next to `output_path` in the background, `output` is its MOVFLAGS layout.
+    A fragmented file is only appended to, every byte on disk is final: `ranges` yields its completed byte
+    ranges while it is encoded, so they can be read before the encode is over. A faststart file is rewritten
+    once encoded and can't be read early. `wait` moves the file to `output_path` once ffmpeg succeeded."""
+
+    def __init__(self, command, output_path, action, output="fragmented"):
+        self.output_path = output_path
+        self.output = output
+        self.path = output_path + ".part"
+        self.action = action
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(command + ["-f", "mp4", self.path], stdout=subprocess.DEVNULL, stderr=self._stderr)
+        self._result = None
+
+    def ranges(self, size, poll=0.2):
+        """Yields (start, end) of each completed `size` bytes range, end excluded, as ffmpeg writes them,
+        then the shorter last one once it succeeded. Stops early if it failed. Only fragmented renders
+        can be read while they are encoded, ValueError for the others."""
+        if self.output != "fragmented":
+            raise ValueError(f"a {self.output} render can't be read while it is encoded")
+        start = 0
+        while True:
+            # Polled first, nothing is written after the last size read.
+            running = self._process.poll() is None
+            written = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            while written - start >= size:
+                yield start, start + size
+                start += size
+            if not running:
+                break
+            time.sleep(poll)
+        if self._process.returncode == 0 and written > start:
+            yield start, written
+
+    def read(self, start, end):
+        """Bytes `start` to `end` (excluded) of the file written so far."""
+        with open(self.output_path if self._result else self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def wait(self):
+        """Waits for ffmpeg, returns True once the file is at `output_path`."""
+        if self._result is None:
+            self._process.wait()
+            self._stderr.seek(0)
+            errors = self._stderr.read().decode("utf-8", "replace").strip()
+            self._stderr.close()
+            self._result = self._process.returncode == 0
+            if self._result:
+                os.replace(self.path, self.output_path)
+            else:
+                print(f"[-] ffmpeg could not {self.action}: {errors}")
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+        return self._result
+
+
+def keyframes(path):
+    """Timestamps in seconds of the keyframes of the first video stream, None if they can't be read.
+    The decoder skips every other frame, this is about as fast as reading the file."""
+    binary = ffmpeg_binary()
+    if not binary:
+        return None
+    result = subprocess.run([binary, "-hide_banner", "-skip_frame", "nokey", "-i", path, "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-"],
+                            capture_output=True, text=True, errors="replace")
+    if result.returncode != 0:
+        return None
+    return [float(t) for t in _PTS_TIME.findall(result.stderr)]
+
+
+def is_constant_frame_rate(path, fps):
+    """Whether the frames of the first video stream are all 1/`fps` apart, read from the packet
+    timestamps without decoding. None if they can't be read."""
+    binary = ffmpeg_binary()
+    if not binary:
+        return None
+    result = subprocess.run([binary, "-hide_banner", "-loglevel", "error", "-i", path, "-map", "0:v:0", "-c", "copy", "-f", "framecrc", "-"],
+                            capture_output=True, text=True, errors="replace")
+    timebase = _FRAMECRC_TB.search(result.stdout)
+    if result.returncode != 0 or not timebase:
+        return None
+    seconds = int(timebase.group(1)) / int(timebase.group(2))
+    pts = sorted(int(t) for t in _FRAMECRC_PTS.findall(result.stdout))
+    # Within a tick of rounding, and 1% of the nominal rate.
+    return all(abs((b - a) * seconds * fps - 1) <= max(0.01, seconds * fps) for a, b in zip(pts, pts[1:]))
+
+
+def trim(source_path, output_path, start, end, preset="medium", crf=23):
+    """Cuts `start` to `end` seconds of a file frame-accurately while re-encoding as little as possible:
+    the frames between the first and the last keyframe of the range are stream-copied, only the partial
+    GOPs at the boundaries are re-encoded, and nothing is when the cut points are keyframes. The audio is
+    re-encoded to AAC. Returns False when ffmpeg is unavailable, the video is not constant frame rate h264
+    or a step fails."""
+    binary = ffmpeg_binary()
+    info = probe(source_path)
+    if not binary or not info or info.video_codec != "h264" or not info.fps:
+        return False
+    # Cut points are frame numbers, they are only right when every frame lasts 1/fps.
+    if not is_constant_frame_rate(source_path, info.fps):
+        return False
+    frames = keyframes(source_path)
+    if frames is None:
+        return False
+
+    # Cut points and keyframes as frame numbers, parts are cut by frame count so none is lost or repeated.
+    fps = info.fps
+    first, last = round(start * fps), round(end * fps)
+    keys = sorted({round(t * fps) for t in frames})
+    inside = [k for k in keys if first <= k < last]
+    last_on_keyframe = last in keys or last >= round(info.duration * fps)
+    copy_end = last if last_on_keyframe else (inside[-1] if inside else first)
+    if not inside or copy_end <= inside[0]:
+        parts = [("encode", first, last)]
+    else:
+        parts = [("encode", first, inside[0]), ("copy", inside[0], copy_end), ("encode", copy_end, last)]
+        parts = [part for part in parts if part[2] > part[1]]
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp_dir:
+        concat_list = os.path.join(tmp_dir, "parts.txt")
+        with open(concat_list, "w") as f:
+            for i, (mode, part_first, part_last) in enumerate(parts):
+                name = os.path.join(tmp_dir, f"{i}.nut")
+                if mode == "copy":
+                    # Input seeking with stream copy starts at the keyframe at or before the position.
+                    command = [binary, "-y", "-hide_banner", "-loglevel", "error", "-ss", f"{(part_first + 0.25) / fps:.6f}", "-i", source_path, "-c:v", "copy"]
+                else:
+                    # Decoding seeks keep the frames from the position on.
+                    command = [binary, "-y", "-hide_banner", "-loglevel", "error", "-ss", f"{max(0, part_first - 0.5) / fps:.6f}", "-i", source_path,
+                               "-c:v", "libx264", "-preset", preset, "-crf", str(crf), "-pix_fmt", info.pixel_format or "yuv420p"]
+                # Annex B keeps each part's parameter sets in band, so encoded and copied parts can be joined.
+                command += ["-map", "0:v:0", "-an", "-frames:v", str(part_last - part_first), "-bsf:v", "h264_mp4toannexb", "-f", "nut", name]
+                result = subprocess.run(command, capture_output=True, text=True)
+                if result.returncode != 0:
+                    print(f"[-] ffmpeg could not {mode} frames {part_first}-{part_last} of {source_path}: {result.stderr.strip()}")
+                    return False
+                f.write(f"file '{name}'\n")
+
+        command = [binary, "-y", "-hide_banner", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", concat_list,
+                   "-ss", f"{first / fps:.6f}", "-t", f"{(last - first) / fps:.6f}", "-i", source_path,
+                   "-map", "0:v:0", "-map", "1:a:0?", "-c:v", "copy", "-c:a", "aac", "-b:a", "192k", "-movflags", "+faststart"]
+        return _write_mp4(command, output_path, f"trim {source_path}")
+
+
+def _write_mp4(command, output_path, action):
+    """Runs `command` writing an .mp4 next to `output_path`, which is only replaced once ffmpeg succeeded."""
+    tmp_path = output_path + ".part"
+    result = subprocess.run(command + ["-f", "mp4", tmp_path], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"[-] ffmpeg could not {action}: {result.stderr.strip()}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+    os.replace(tmp_path, output_path)
+    return True
@@ -0,0 +1,141 @@
+import asyncio, requests, threading
+import aiohttp
+from yarl import URL
+from fake_useragent import FakeUserAgentError, UserAgent
+from tiktok_uploader.Config import Config
+
+
+# Constants
+TIKTOK_URL = URL("https://www.tiktok.com")
+_UA = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/68.0.3440.106 Safari/537.36'
+
+
+def get_user_agent():
+	try:
+		return UserAgent().random
+	except FakeUserAgentError as e:
+		print("[-] Could not get random user agent, using default")
+		return _UA
+
+
+class SessionPool:
+	"""Keeps `requests.Session`s per (account, proxy) for the life of the process, so consecutive
+	uploads reuse their keep-alive connections to tiktok.com and the upload hosts instead of paying a
+	new TCP + TLS handshake for each request. A session is used by one upload at a time: `session`
+	hands out an idle one, or a new one when all are busy, and `release` gives it back, so concurrent
+	uploads to an account do not share a cookie jar. Each session keeps the user agent it was created with."""
+	__instance = None
+	__lock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if SessionPool.__instance is None:
+			with SessionPool.__lock:
+				if SessionPool.__instance is None:
+					SessionPool.__instance = SessionPool()
+		return SessionPool.__instance
+
+	def __init__(self):
+		self._idle = {}
+		self._keys = {}
+		self._lock = threading.Lock()
+
+	def session(self, session_user, session_id, dc_id, proxy=None):
+		key = (session_user, proxy or None)
+		with self._lock:
+			idle = self._idle.get(key)
+			session = idle.pop() if idle else None
+		if session is None:
+			session = new_session(get_user_agent(), proxy)
+			with self._lock:
+				self._keys[session] = key
+		session.cookies.set("sessionid", session_id, domain=".tiktok.com")
+		session.cookies.set("tt-target-idc", dc_id, domain=".tiktok.com")
+		return session
+
+	def release(self, session):
+		"""Gives back a session handed out by `session` once its upload is done."""
+		with self._lock:
+			key = self._keys.get(session)
+			if key is not None:
+				self._idle.setdefault(key, []).append(session)
+
+	def close(self):
+		with self._lock:
+			for session in self._keys:
+				session.close()
+			self._idle = {}
+			self._keys = {}
+
+
+class AsyncSessionPool:
+	"""Asyncio counterpart of `SessionPool`, keeps one `aiohttp.ClientSession` per (account, proxy) and
+	event loop. A ClientSession can be used by concurrent requests of its loop, so the uploads of an
+	account share it. Await `close` before the loop ends."""
+	__instance = None
+	__lock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if AsyncSessionPool.__instance is None:
+			with AsyncSessionPool.__lock:
+				if AsyncSessionPool.__instance is None:
+					AsyncSessionPool.__instance = AsyncSessionPool()
+		return AsyncSessionPool.__instance
+
+	def __init__(self):
+		self._sessions = {}
+		self._lock = threading.Lock()
+
+	def session(self, session_user, session_id, dc_id, proxy=None):
+		"""Returns the session of the running loop for this account and proxy, the proxy itself is passed to each request."""
+		key = (asyncio.get_running_loop(), session_user, proxy or None)
+		with self._lock:
+			http = self._sessions.get(key)
+			if http is None or http.closed:
+				http = self._sessions[key] = new_client_session(get_user_agent())
+		http.cookie_jar.update_cookies({"sessionid": session_id, "tt-target-idc": dc_id}, TIKTOK_URL)
+		return http
+
+	async def close(self):
+		"""Closes the sessions of the running loop."""
+		loop = asyncio.get_running_loop()
+		with self._lock:
+			sessions = [self._sessions.pop(key) for key in list(self._sessions) if key[0] is loop]
+		for http in sessions:
+			await http.close()
+
+
+def new_session(user_agent, proxy=None):
+	"""Session with connection pools sized from the config, one pool per host and enough
+	connections per pool for every part uploaded in parallel."""
+	config = Config.get()
+	session = requests.Session()
+	session.verify = True
+	adapter = requests.adapters.HTTPAdapter(pool_connections=config.http_pool_connections, pool_maxsize=max(config.http_pool_maxsize, config.upload_concurrency))
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	session.headers.update({
+		'User-Agent': user_agent,
+		'Accept': 'application/json, text/plain, */*',
+	})
+
+	# Setting proxy if provided.
+	if proxy:
+		session.proxies = {
+			"http": proxy,
+			"https": proxy
+		}
+	return session
+
+
+def new_client_session(user_agent):
+	"""aiohttp counterpart of `new_session`, the connector is sized the same way."""
+	config = Config.get()
+	per_host = max(config.http_pool_maxsize, config.upload_concurrency)
+	connector = aiohttp.TCPConnector(limit=per_host * config.http_pool_connections, limit_per_host=per_host)
+	headers = {
+		'User-Agent': user_agent,
+		'Accept': 'application/json, text/plain, */*',
+	}
+	return aiohttp.ClientSession(headers=headers, connector=connector)
@@ -0,0 +1,152 @@
+import requests, threading, asyncio, json, time, os
+import aiohttp
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from tiktok_uploader.bot_utils import subprocess_jsvmp, assert_success
+from tiktok_uploader.Config import Config
+
+
+SIGNATURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktok-signature")
+
+
+class TTLCache:
+	"""Thread-safe mapping whose entries expire after `ttl` seconds, the least recently used
+	entry is evicted once `max_size` entries are stored."""
+
+	def __init__(self, ttl, max_size):
+		self.ttl = ttl
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None or entry[0] < time.monotonic():
+				if entry is not None:
+					del self._entries[key]
+				self.misses += 1
+				return None
+			self._entries.move_to_end(key)
+			self.hits += 1
+			return entry[1]
+
+	def set(self, key, value):
+		with self._lock:
+			self._entries[key] = (time.monotonic() + self.ttl, value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+
+	def info(self):
+		with self._lock:
+			return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self.max_size, "ttl": self.ttl}
+
+
+def signature_cache_key(url, user_agent):
+	"""Key of a signature, the url with its query parameters sorted plus the user agent."""
+	parts = urlsplit(url)
+	query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+	return f"{parts.scheme}://{parts.netloc}{parts.path}?{query}", user_agent
+
+
+class SignerClient:
+	"""Client for the persistent signature server, start it with `npm start` in `tiktok-signature`.
+	Keeps a pool of keep-alive connections to the server, and falls back to a one-shot `browser.js`
+	process (one Chromium launch per signature) when the server is not running.
+	Signatures are cached per (url, user agent), the signer appends a fixed verifyFp so the
+	same url always gets the same valid signature until the cache entry expires."""
+	__instance = None
+	__lock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if SignerClient.__instance is None:
+			with SignerClient.__lock:
+				if SignerClient.__instance is None:
+					SignerClient.__instance = SignerClient()
+		return SignerClient.__instance
+
+	def __init__(self, url=None, pool_size=10):
+		self.url = url or Config.get().signer_url
+		self.session = requests.Session()
+		# The server is local, never route it through environment proxies.
+		self.session.trust_env = False
+		self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+		config = Config.get()
+		self.cache = TTLCache(config.signature_cache_ttl, config.signature_cache_size)
+
+	def sign(self, url, user_agent):
+		"""Returns the signature data (`x-bogus`, `signature`, `signed_url`, ...) for `url`, None on failure."""
+		key = signature_cache_key(url, user_agent)
+		signature = self.cache.get(key)
+		if signature is None:
+			signature = self._sign(url, user_agent)
+			if signature:
+				self.cache.set(key, signature)
+		return signature
+
+	async def sign_async(self, url, user_agent, http):
+		"""Awaitable `sign`, the server is called through the aiohttp session `http`."""
+		key = signature_cache_key(url, user_agent)
+		signature = self.cache.get(key)
+		if signature is None:
+			signature = await self._sign_async(url, user_agent, http)
+			if signature:
+				self.cache.set(key, signature)
+		return signature
+
+	def cache_info(self):
+		"""Returns hit/miss counters and size of the signature cache."""
+		return self.cache.info()
+
+	def _sign(self, url, user_agent):
+		try:
+			r = self.session.post(self.url, json={"url": url, "user_agent": user_agent}, timeout=60)
+		except requests.RequestException as e:
+			print(f"[-] Signature server not reachable at {self.url} ({e.__class__.__name__}), using a one-shot signer")
+			return self._sign_subprocess(url, user_agent)
+		if not assert_success(self.url, r):
+			return None
+		return r.json()["data"]
+
+	async def _sign_async(self, url, user_agent, http):
+		try:
+			async with http.post(self.url, json={"url": url, "user_agent": user_agent}, proxy=None) as r:
+				if r.status != 200:
+					print(f"[-] An error occured while reaching {self.url}")
+					print(f"{r.status}")
+					print(f"{await r.read()}")
+					return None
+				return (await r.json())["data"]
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			print(f"[-] Signature server not reachable at {self.url} ({e.__class__.__name__}), using a one-shot signer")
+		proc = await asyncio.create_subprocess_exec("node", os.path.join(SIGNATURE_DIR, "browser.js"), url, user_agent, stdout=asyncio.subprocess.PIPE)
+		output = (await proc.communicate())[0].decode("utf-8")
+		try:
+			return json.loads(output)["data"]
+		except (ValueError, KeyError):
+			print(f"[-] Could not sign url: {output}")
+			return None
+
+	def metrics(self):
+		"""Returns the server's page pool metrics (pool size, busy pages, queue depth, ...), None if unavailable."""
+		url = self.url.rsplit("/", 1)[0] + "/metrics"
+		try:
+			r = self.session.get(url, timeout=10)
+		except requests.RequestException:
+			return None
+		if not assert_success(url, r):
+			return None
+		return r.json()["data"]
+
+	@staticmethod
+	def _sign_subprocess(url, user_agent):
+		output = subprocess_jsvmp(os.path.join(SIGNATURE_DIR, "browser.js"), user_agent, url)
+		try:
+			return json.loads(output)["data"]
+		except (ValueError, KeyError):
+			print(f"[-] Could not sign url: {output}")
+			return None
@@ -0,0 +1,92 @@
+import sqlite3, threading, json, time, os
+from contextlib import contextmanager
+from tiktok_uploader.Config import Config
+
+
+class Store:
+	"""SQLite database (`tiktok_uploader.db` in CACHE_DIR) holding the local caches and indexes.
+	One connection is shared by the threads of a process, several processes can use the same file."""
+	__instance = None
+	__lock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if Store.__instance is None:
+			with Store.__lock:
+				if Store.__instance is None:
+					Store.__instance = Store()
+		return Store.__instance
+
+	def __init__(self, path=None):
+		if not path:
+			cache_dir = os.path.join(os.getcwd(), Config.get().cache_dir)
+			os.makedirs(cache_dir, exist_ok=True)
+			path = os.path.join(cache_dir, "tiktok_uploader.db")
+		self.path = path
+		self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+		self._conn.execute("PRAGMA journal_mode=WAL")
+		self._lock = threading.RLock()
+
+	def execute(self, sql, params=()):
+		with self._lock:
+			return self._conn.execute(sql, params).fetchall()
+
+	def executemany(self, sql, rows):
+		with self._lock:
+			self._conn.executemany(sql, rows)
+
+	@contextmanager
+	def transaction(self):
+		"""Runs the enclosed statements atomically, other threads wait until it is done."""
+		with self._lock:
+			self._conn.execute("BEGIN IMMEDIATE")
+			try:
+				yield self
+			except BaseException:
+				self._conn.execute("ROLLBACK")
+				raise
+			self._conn.execute("COMMIT")
+
+
+class CacheTable:
+	"""Persistent key -> JSON value cache stored in a `Store` table. Entries expire `ttl` seconds
+	after being set, and the least recently used ones are evicted above `max_size` entries."""
+
+	def __init__(self, name, ttl, max_size, store=None):
+		self.table = f"cache_{name}"
+		self.ttl = ttl
+		self.max_size = max_size
+		self.store = store or Store.get()
+		self.store.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)")
+
+	def get(self, key):
+		return self.get_many([key]).get(key)
+
+	def get_many(self, keys):
+		"""Returns the fresh cached values of `keys` as a dict, missing keys are left out."""
+		keys = list(dict.fromkeys(keys))
+		if not keys:
+			return {}
+		now = time.time()
+		values = {}
+		with self.store.transaction():
+			# SQLite limits the number of bound parameters, query in slices.
+			for i in range(0, len(keys), 500):
+				batch = keys[i:i + 500]
+				marks = ",".join("?" * len(batch))
+				rows = self.store.execute(f"SELECT key, value FROM {self.table} WHERE key IN ({marks}) AND created > ?", (*batch, now - self.ttl))
+				values.update((key, json.loads(value)) for key, value in rows)
+				self.store.execute(f"UPDATE {self.table} SET used = ? WHERE key IN ({marks})", (now, *batch))
+		return values
+
+	def set(self, key, value):
+		self.set_many({key: value})
+
+	def set_many(self, values):
+		if not values:
+			return
+		now = time.time()
+		with self.store.transaction():
+			self.store.executemany(f"INSERT OR REPLACE INTO {self.table} (key, value, created, used) VALUES (?, ?, ?, ?)", [(key, json.dumps(value), now, now) for key, value in values.items()])
+			self.store.execute(f"DELETE FROM {self.table} WHERE created <= ?", (now - self.ttl,))
+			self.store.execute(f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY used DESC, rowid DESC LIMIT -1 OFFSET ?)", (self.max_size,))
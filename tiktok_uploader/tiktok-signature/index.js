@@ -18,7 +18,7 @@ class Signer {
   // Password for xttparams AES encryption
   password = "webapp1.0+202106";
 
-  constructor(default_url, userAgent, browser) {
+  constructor(default_url, userAgent, browser, poolSize) {
     if (default_url) {
       this.default_url = default_url;
     }
@@ -31,6 +31,12 @@ class Signer {
       this.isExternalBrowser = true;
     }
 
+    // Number of pages signing in parallel, each with its own emulation profile.
+    this.poolSize = poolSize || 1;
+    this.idle = [];
+    this.waiting = [];
+    this.signed = 0;
+
     this.args.push(`--user-agent="${this.userAgent}"`);
 
     this.options = {
@@ -46,8 +52,19 @@ class Signer {
       this.browser = await chromium.launch(this.options);
     }
 
+    const pages = await Promise.all(
+      Array.from({ length: this.poolSize }, () => this.newPage())
+    );
+    this.contexts = pages.map((page) => page.context());
+    this.context = this.contexts[0];
+    this.page = pages[0];
+    this.idle = pages;
+  }
+
+  async newPage() {
     let emulateTemplate = {
       ...iPhone11,
+      viewport: { ...iPhone11.viewport },
       locale: "en-US",
       deviceScaleFactor: Utils.getRandomInt(1, 3),
       isMobile: Math.random() > 0.5,
@@ -57,32 +74,32 @@ class Signer {
     emulateTemplate.viewport.width = Utils.getRandomInt(320, 1920);
     emulateTemplate.viewport.height = Utils.getRandomInt(320, 1920);
 
-    this.context = await this.browser.newContext({
+    const context = await this.browser.newContext({
       bypassCSP: true,
       ...emulateTemplate,
     });
 
-    this.page = await this.context.newPage();
+    const page = await context.newPage();
 
-    await this.page.route("**/*", (route) => {
+    await page.route("**/*", (route) => {
       return route.request().resourceType() === "script"
         ? route.abort()
         : route.continue();
     });
 
-    await this.page.goto(this.default_url, {
+    await page.goto(this.default_url, {
       waitUntil: "networkidle",
     });
 
     let LOAD_SCRIPTS = ["signer.js", "webmssdk.js", "xbogus.js"];
     LOAD_SCRIPTS.forEach(async (script) => {
-      await this.page.addScriptTag({
+      await page.addScriptTag({
         path: `${__dirname}/javascript/${script}`,
       });
       // console.log("[+] " + script + " loaded");
     });
 
-    await this.page.evaluate(() => {
+    await page.evaluate(() => {
       window.generateSignature = function generateSignature(url) {
         if (typeof window.byted_acrawler.sign !== "function") {
           throw "No signature function found";
@@ -98,6 +115,7 @@ class Signer {
       };
       return this;
     });
+    return page;
   }
 
   async navigator() {
@@ -114,14 +132,51 @@ class Signer {
     });
     return info;
   }
+
+  acquire() {
+    if (this.idle.length) {
+      return Promise.resolve(this.idle.pop());
+    }
+    return new Promise((resolve) => this.waiting.push(resolve));
+  }
+
+  release(page) {
+    if (this.waiting.length) {
+      this.waiting.shift()(page);
+    } else {
+      this.idle.push(page);
+    }
+  }
+
+  metrics() {
+    return {
+      pool_size: this.poolSize,
+      idle: this.idle.length,
+      busy: this.poolSize - this.idle.length,
+      queue_depth: this.waiting.length,
+      signed: this.signed,
+    };
+  }
+
   async sign(link) {
+    const page = await this.acquire();
+    try {
+      const result = await this.signWith(page, link);
+      this.signed++;
+      return result;
+    } finally {
+      this.release(page);
+    }
+  }
+
+  async signWith(page, link) {
     // generate valid verifyFp
     let verify_fp = Utils.generateVerifyFp();
     let newUrl = link + "&verifyFp=" + verify_fp;
-    let token = await this.page.evaluate(`generateSignature("${newUrl}")`);
+    let token = await page.evaluate(`generateSignature("${newUrl}")`);
     let signed_url = newUrl + "&_signature=" + token;
     let queryString = new URL(signed_url).searchParams.toString();
-    let bogus = await this.page.evaluate(`generateBogus("${queryString}","${this.userAgent}")`);
+    let bogus = await page.evaluate(`generateBogus("${queryString}","${this.userAgent}")`);
     signed_url += "&X-Bogus=" + bogus;
 
 
@@ -148,6 +203,12 @@ class Signer {
       await this.browser.close();
       this.browser = null;
     }
+    if (this.contexts && this.isExternalBrowser) {
+      await Promise.all(this.contexts.map((context) => context.close()));
+    }
+    this.contexts = null;
+    this.context = null;
+    this.idle = [];
     if (this.page) {
       this.page = null;
     }
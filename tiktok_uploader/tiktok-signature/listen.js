@@ -0,0 +1,133 @@
+const http = require("http");
+const { chromium } = require("playwright-chromium");
+const Signer = require("./index");
+
+const PORT = parseInt(process.env.PORT || "8080");
+// Signers are kept warm per user agent, as X-Bogus depends on it.
+const MAX_SIGNERS = parseInt(process.env.SIGNER_MAX_AGENTS || "8");
+// Pages per signer, i.e. how many signatures of one user agent run in parallel.
+const POOL_SIZE = parseInt(process.env.SIGNER_POOL_SIZE || "2");
+
+// User agent -> { signer, users, evicted }, `users` counts the requests using the signer.
+const signers = new Map();
+
+// Takes the signer entry of `userAgent` for one request, give it back with releaseSigner.
+function getSigner(browser, userAgent) {
+  let entry = signers.get(userAgent);
+  if (entry) {
+    // Refresh insertion order, the map doubles as an LRU.
+    signers.delete(userAgent);
+    signers.set(userAgent, entry);
+    entry.users++;
+    return entry;
+  }
+
+  const signer = (async () => {
+    const s = new Signer(null, userAgent, browser, POOL_SIZE);
+    await s.init();
+    return s;
+  })();
+  entry = { signer: signer, users: 1, evicted: false };
+  signer.catch(() => {
+    if (signers.get(userAgent) === entry) signers.delete(userAgent);
+  });
+  signers.set(userAgent, entry);
+
+  if (signers.size > MAX_SIGNERS) {
+    const [oldest, evicted] = signers.entries().next().value;
+    signers.delete(oldest);
+    evicted.evicted = true;
+    // Requests still using it, with a busy page or waiting for one, finish before it is closed.
+    if (evicted.users === 0) closeSigner(evicted);
+  }
+  return entry;
+}
+
+function releaseSigner(entry) {
+  entry.users--;
+  if (entry.evicted && entry.users === 0) closeSigner(entry);
+}
+
+function closeSigner(entry) {
+  entry.signer.then((s) => s.close()).catch(() => {});
+}
+
+async function metrics() {
+  const agents = [];
+  for (const entry of signers.values()) {
+    try {
+      agents.push((await entry.signer).metrics());
+    } catch (err) {
+      // Failed signers are dropped from the map, skip them.
+    }
+  }
+  const total = (key) => agents.reduce((sum, m) => sum + m[key], 0);
+  return {
+    signers: agents.length,
+    pool_size: total("pool_size"),
+    busy: total("busy"),
+    queue_depth: total("queue_depth"),
+    signed: total("signed"),
+    agents: agents,
+  };
+}
+
+function readBody(request) {
+  return new Promise((resolve, reject) => {
+    let body = "";
+    request.on("data", (chunk) => (body += chunk));
+    request.on("end", () => resolve(body));
+    request.on("error", reject);
+  });
+}
+
+function send(response, code, payload) {
+  response.writeHead(code, { "Content-Type": "application/json" });
+  response.end(JSON.stringify(payload));
+}
+
+(async function main() {
+  const defaults = new Signer();
+  const browser = await chromium.launch(defaults.options);
+
+  const server = http.createServer(async (request, response) => {
+    if (request.method === "GET" && request.url === "/metrics") {
+      return send(response, 200, { status: "ok", data: await metrics() });
+    }
+    if (request.method !== "POST" || request.url !== "/signature") {
+      return send(response, 404, { status: "error", error: "Not found" });
+    }
+    let entry = null;
+    try {
+      const body = JSON.parse(await readBody(request));
+      entry = getSigner(browser, body.user_agent || defaults.userAgent);
+      const signer = await entry.signer;
+      const sign = await signer.sign(body.url);
+      const navigator = await signer.navigator();
+      send(response, 200, {
+        status: "ok",
+        data: {
+          ...sign,
+          navigator: navigator,
+        },
+      });
+    } catch (err) {
+      console.error(err);
+      send(response, 500, { status: "error", error: String(err) });
+    } finally {
+      if (entry) releaseSigner(entry);
+    }
+  });
+
+  const shutdown = async () => {
+    server.close();
+    await browser.close();
+    process.exit(0);
+  };
+  process.on("SIGINT", shutdown);
+  process.on("SIGTERM", shutdown);
+
+  server.listen(PORT, "127.0.0.1", () => {
+    console.log("[+] TikTok signature server listening on 127.0.0.1:" + PORT);
+  });
+})();
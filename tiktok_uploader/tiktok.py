@@ -1,10 +1,15 @@
 import time, requests, datetime, hashlib, hmac, random, zlib, json, datetime
 import requests, zlib, json, time, subprocess, string, secrets, os, sys
-from fake_useragent import FakeUserAgentError, UserAgent
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from requests_auth_aws_sigv4 import AWSSigV4
 from tiktok_uploader.cookies import load_cookies_from_file
 from tiktok_uploader.Browser import Browser
 from tiktok_uploader.bot_utils import *
+from tiktok_uploader.signer import SignerClient
+from tiktok_uploader.sessions import SessionPool, get_user_agent
+from tiktok_uploader.title import compile_title, MAX_TITLE_LENGTH
+from tiktok_uploader.ffmpeg import RenderStream
+from tiktok_uploader.upload_index import UploadIndex, TitleIndex
 from tiktok_uploader import Config, Video, eprint
 from dotenv import load_dotenv
 
@@ -12,9 +17,6 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
-# Constants
-_UA = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/68.0.3440.106 Safari/537.36'
-
 
 def login(login_name: str):
 	# Check if login name is already save in file.
@@ -45,62 +47,48 @@ def login(login_name: str):
 	return cookie_name.get('value', '') if cookie_name else ''
 
 
-def upload_video(session_user, video, title, schedule_time=0, allow_comment=1, allow_duet=0, allow_stitch=0, visibility_type=0, brand_organic_type=0, branded_content_type=0, ai_label=0, proxy=None):
-	try:
-		user_agent = UserAgent().random
-	except FakeUserAgentError as e:
-		user_agent = _UA
-		print("[-] Could not get random user agent, using default")
-
-	cookies = load_cookies_from_file(f"tiktok_session-{session_user}")
-	session_id = next((c["value"] for c in cookies if c["name"] == 'sessionid'), None)
-	dc_id = next((c["value"] for c in cookies if c["name"] == 'tt-target-idc'), None)
-	
+def upload_video(session_user, video, title, schedule_time=0, allow_comment=1, allow_duet=0, allow_stitch=0, visibility_type=0, brand_organic_type=0, branded_content_type=0, ai_label=0, proxy=None, allow_duplicate=False):
+	"""Returns True once uploaded, False if the upload failed, None if this video was already sent to the user and is refused."""
+	session_id, dc_id = load_session(session_user)
 	if not session_id:
 		eprint("No cookie with Tiktok session id found: use login to save session id")
 		sys.exit(1)
-	if not dc_id:
-		print("[WARNING]: Please login, tiktok datacenter id must be allocated, or may fail")
-		dc_id = "useast2a"
 	print("User successfully logged in.")
 	print(f"Tiktok Datacenter Assigned: {dc_id}")
-	
+
 	print("Uploading video...")
-	# Parameter validation,
-	if schedule_time and (schedule_time > 864000 or schedule_time < 900):
-		print("[-] Cannot schedule video in more than 10 days or less than 20 minutes")
-		return False
-	if len(title) > 2200:
-		print("[-] The title has to be less than 2200 characters")
-		return False
-	if schedule_time != 0 and visibility_type == 1:
-		print("[-] Private videos cannot be uploaded with schedule")
+	if not validate_upload(title, schedule_time, visibility_type):
 		return False
 
 	# Check video length - 1 minute max, takes too long to run this.
 
+	# The content is hashed before anything is sent, a video already uploaded to the account is not sent again.
+	digest = video_digest(video)
+	if not digest:
+		return False
+	sha256, part_crcs = digest
+	creation_id = generate_random_string(21, True)
+	previous = UploadIndex.get().claim(sha256, session_user, creation_id, force=allow_duplicate)
+	if previous:
+		print(f"[-] This video was already sent to {session_user} (status {previous['status']}, creation id {previous['creation_id']}), use allow_duplicate to send it again")
+		return None
 
-	# Creating Session
-	session = requests.Session()
-	session.cookies.set("sessionid", session_id, domain=".tiktok.com")
-	session.cookies.set("tt-target-idc", dc_id, domain=".tiktok.com")
-	session.verify = True
-
-	headers = {
-		'User-Agent': user_agent,
-		'Accept': 'application/json, text/plain, */*',
-	}
-	session.headers.update(headers)
+	# Sessions are kept per account and proxy, connections are reused between uploads.
+	session = SessionPool.get().session(session_user, session_id, dc_id, proxy)
+	uploaded = False
+	try:
+		uploaded = _upload(session, session_user, video, title, creation_id, sha256, part_crcs, schedule_time, allow_comment, allow_duet, allow_stitch, visibility_type, ai_label)
+	finally:
+		SessionPool.get().release(session)
+		UploadIndex.get().finish(sha256, session_user, uploaded)
+	if uploaded:
+		TitleIndex.get().add(session_user, [title], "upload")
+	return uploaded
 
 
-	# Setting proxy if provided.
-	if proxy:
-		session.proxies = {
-			"http": proxy,
-			"https": proxy
-		}
+def _upload(session, session_user, video, title, creation_id, sha256, part_crcs, schedule_time, allow_comment, allow_duet, allow_stitch, visibility_type, ai_label):
+	user_agent = session.headers["User-Agent"]
 
-	creation_id = generate_random_string(21, True)
 	project_url = f"https://www.tiktok.com/api/v1/web/project/create/?creation_id={creation_id}&type=1&aid=1988"
 	r = session.post(project_url)
 
@@ -109,26 +97,25 @@ def upload_video(session_user, video, title, schedule_time=0, allow_comment=1, a
 
 	# get project_id
 	project_id = r.json()["project"]["project_id"]
-	video_id, session_key, upload_id, crcs, upload_host, store_uri, video_auth, aws_auth = upload_to_tiktok(video, session)
+	uploaded_parts = upload_to_tiktok(video, session, part_crcs)
+	if not uploaded_parts:
+		return False
+	video_id, session_key, upload_id, crcs, upload_host, store_uri, video_auth, aws_auth = uploaded_parts
+	UploadIndex.get().update(sha256, session_user, video_id=video_id)
 
 	url = f"https://{upload_host}/{store_uri}?uploadID={upload_id}&phase=finish&uploadmode=part"
 	headers = {
 		"Authorization": video_auth,
 		"Content-Type": "text/plain;charset=UTF-8",
 	}
-	data = ",".join([f"{i + 1}:{crcs[i]}" for i in range(len(crcs))])
+	data = finish_payload(crcs)
 
-	if proxy:
-		r = requests.post(url, headers=headers, data=data, proxies=session.proxies)
-		if not assert_success(url, r):
-			return False
-	else:
-		r = requests.post(url, headers=headers, data=data)
-		if not assert_success(url, r):
-			return False
+	r = session.post(url, headers=headers, data=data)
+	if not assert_success(url, r):
+		return False
 
 	url = f"https://www.tiktok.com/top/v1?Action=CommitUploadInner&Version=2020-11-19&SpaceName=tiktok"
-	data = '{"SessionKey":"' + session_key + '","Functions":[{"name":"GetMeta"}]}'
+	data = commit_payload(session_key)
 
 	r = session.post(url, auth=aws_auth, data=data)
 	if not assert_success(url, r):
@@ -148,11 +135,90 @@ def upload_video(session_user, video, title, schedule_time=0, allow_comment=1, a
 		"content-type": "application/json",
 		"user-agent": user_agent
 	}
+	markup_text, text_extra = convert_tags(title, session)
+	data = build_post_data(title, markup_text, text_extra, project_id, video_id, creation_id, schedule_time, allow_comment, allow_duet, allow_stitch, visibility_type, ai_label)
+	poll = poll_backoff()
+	while True:
+		mstoken = session.cookies.get("msToken")
+		tt_output = SignerClient.get().sign(project_post_sign_url(mstoken), user_agent)
+		if not tt_output:
+			print("[-] Could not sign project post request")
+			return False
+		r = session.request("POST", PROJECT_POST_URL, params=project_post_params(mstoken, tt_output), data=json.dumps(data), headers=headers)
+		try:
+			if r.json()["status_msg"] == "You are posting too fast. Take a rest.":
+				print("[-] You are posting too fast, try later again")
+				return False
+			print(r.json())
+			break
+		except Exception as e:
+			delay = poll.next_delay()
+			if delay is None:
+				print("[-] Could not upload video, TikTok did not accept the post in time")
+				return False
+			print("[-] Waiting for TikTok to process video...")
+			time.sleep(delay)
+
+	# The post went through, from here on the video may be published even if its status is never confirmed.
+	UploadIndex.get().update(sha256, session_user, status="posted_unconfirmed")
+
+	# Check if video uploaded successfully
+	url = f"https://www.tiktok.com/api/v1/web/project/list/?aid=1988"
+	poll = poll_backoff(Config.get().poll_status_deadline)
+	while True:
+		r = session.get(url)
+		if not assert_success(url, r):
+			return False
+		status = project_status(r.json()["infos"], creation_id)
+		if status is not None and status not in PROJECT_PENDING_STATUSES:
+			if status != "Success":
+				# Rejected by TikTok, it can be sent again.
+				UploadIndex.get().update(sha256, session_user, status="failed")
+			return report_project_status(status)
+		delay = poll.next_delay()
+		if delay is None:
+			return report_project_status(status)
+		time.sleep(delay)
+
+
+def load_session(session_user):
+	"""Returns the saved (sessionid, tt-target-idc) cookie values of `session_user`, sessionid is None when not logged in."""
+	cookies = load_cookies_from_file(f"tiktok_session-{session_user}")
+	session_id = next((c["value"] for c in cookies if c["name"] == 'sessionid'), None)
+	dc_id = next((c["value"] for c in cookies if c["name"] == 'tt-target-idc'), None)
+	if session_id and not dc_id:
+		print("[WARNING]: Please login, tiktok datacenter id must be allocated, or may fail")
+		dc_id = "useast2a"
+	return session_id, dc_id
+
+
+def validate_upload(title, schedule_time, visibility_type):
+	# Parameter validation,
+	if schedule_time and (schedule_time > 864000 or schedule_time < 900):
+		print("[-] Cannot schedule video in more than 10 days or less than 20 minutes")
+		return False
+	if not compile_title(title).is_valid:
+		print(f"[-] The title has to be less than {MAX_TITLE_LENGTH} characters")
+		return False
+	if schedule_time != 0 and visibility_type == 1:
+		print("[-] Private videos cannot be uploaded with schedule")
+		return False
+	return True
+
+
+def finish_payload(crcs):
+	return ",".join([f"{i + 1}:{crcs[i]}" for i in range(len(crcs))])
+
+
+def commit_payload(session_key):
+	return '{"SessionKey":"' + session_key + '","Functions":[{"name":"GetMeta"}]}'
+
+
+def build_post_data(title, markup_text, text_extra, project_id, video_id, creation_id, schedule_time=0, allow_comment=1, allow_duet=0, allow_stitch=0, visibility_type=0, ai_label=0):
 	brand = ""
 
 	if brand and brand[-1] == ",":
 		brand = brand[:-1]
-	markup_text, text_extra = convert_tags(title, session)
 	data = {
 		"upload_param": {
 			"video_param": {
@@ -184,108 +250,189 @@ def upload_video(session_user, video, title, schedule_time=0, allow_comment=1, a
 	}
 	if schedule_time:
 		data["upload_param"]["schedule_time"] = schedule_time + int(time.time())
-	uploaded = False
-	while True:
-		mstoken = session.cookies.get("msToken")
-		# xbogus = subprocess_jsvmp(os.path.join(os.getcwd(), "tiktok_uploader", "./x-bogus.js"), user_agent, f"app_name=tiktok_web&channel=tiktok_web&device_platform=web&aid=1988&msToken={mstoken}")
-		signatures = subprocess_jsvmp(f"/home/{os.getlogin()}/TikTok_Uploader/tiktok_uploader/tiktok-signature/browser.js", user_agent, f"https://www.tiktok.com/api/v1/web/project/post/?app_name=tiktok_web&channel=tiktok_web&device_platform=web&aid=1988&msToken={mstoken}")
-		tt_output = json.loads(signatures)["data"]
-		project_post_dict = {
-			"app_name": "tiktok_web",
-			"channel": "tiktok_web",
-			"device_platform": "web",
-			"aid": 1988,
-			"msToken": mstoken,
-			"X-Bogus": tt_output["x-bogus"],
-			"_signature": tt_output["signature"],
-			# "X-TT-Params": tt_output["x-tt-params"],  # not needed rn.
-		}
-		url = f"https://www.tiktok.com/api/v1/web/project/post/"
-		r = session.request("POST", url, params=project_post_dict, data=json.dumps(data), headers=headers)
-		try:
-			if r.json()["status_msg"] == "You are posting too fast. Take a rest.":
-				print("[-] You are posting too fast, try later again")
-				return False
-			print(r.json())
-			uploaded = True
-			break
-		except Exception as e:
-			print("[-] Waiting for TikTok to process video...")
-			time.sleep(1.5)  # wait 1.5 seconds before asking again.
-	if not uploaded:
-		print("[-] Could not upload video")
-		return False
+	return data
 
-	# Check if video uploaded successfully
-	url = f"https://www.tiktok.com/api/v1/web/project/list/?aid=1988"
 
-	r = session.get(url)
-	if not assert_success(url, r):
-		return False
-	# print(r.json()["infos"])
-	for j in r.json()["infos"]:
-		if j["creationID"] == creation_id:
-			if j["tasks"][0]["status_msg"] == "Y project task init" or j["tasks"][0]["status_msg"] == "Success":
-				print("[+] Video uploaded successfully.")
-				return True
-			print(f"[-] Video could not be uploaded: {j['tasks'][0]['status_msg']}")
-			return False
+PROJECT_POST_URL = "https://www.tiktok.com/api/v1/web/project/post/"
+
 
+def project_post_sign_url(mstoken):
+	return f"{PROJECT_POST_URL}?app_name=tiktok_web&channel=tiktok_web&device_platform=web&aid=1988&msToken={mstoken}"
 
-def upload_to_tiktok(video_file, session):
+
+def project_post_params(mstoken, tt_output):
+	return {
+		"app_name": "tiktok_web",
+		"channel": "tiktok_web",
+		"device_platform": "web",
+		"aid": 1988,
+		"msToken": mstoken,
+		"X-Bogus": tt_output["x-bogus"],
+		"_signature": tt_output["signature"],
+		# "X-TT-Params": tt_output["x-tt-params"],  # not needed rn.
+	}
+
+
+# Statuses of a project task still being processed, polling goes on while a video is in one of them.
+PROJECT_PENDING_STATUSES = ["Y project task init"]
+
+
+def poll_backoff(deadline=None):
+	config = Config.get()
+	return Backoff(config.poll_initial_delay, config.poll_max_delay, deadline or config.poll_deadline, config.poll_max_attempts)
+
+
+def project_status(infos, creation_id):
+	"""Returns the status message of the task of `creation_id` in a project list, None if it is not listed yet."""
+	# print(infos)
+	for j in infos:
+		if j["creationID"] == creation_id:
+			return j["tasks"][0]["status_msg"]
+	return None
+
+
+def report_project_status(status):
+	if status == "Success":
+		print("[+] Video uploaded successfully.")
+		return True
+	if status in PROJECT_PENDING_STATUSES:
+		print("[+] Video uploaded successfully, TikTok is still processing it.")
+		return True
+	if status is None:
+		print("[-] Video could not be found in the project list")
+		return False
+	print(f"[-] Video could not be uploaded: {status}")
+	return False
+
+
+def video_path(video_file):
+	"""Path of a video file name in VIDEOS_DIR, or of the output of a finished ffmpeg.RenderStream."""
+	if isinstance(video_file, RenderStream):
+		return video_file.output_path
+	return os.path.join(os.getcwd(), Config.get().videos_dir, video_file)
+
+
+def video_digest(video_file):
+	"""Returns (SHA-256, upload part CRCs) of a video file name in VIDEOS_DIR, or of a fragmented
+	ffmpeg.RenderStream whose parts are hashed as they are encoded. None if the render failed.
+	Only the hashing overlaps the encode: ApplyUploadInner declares the file size before any part is
+	sent, so the transfer starts once the render is done."""
+	if isinstance(video_file, RenderStream):
+		if video_file.output != "fragmented":
+			print(f"[-] Only fragmented renders can be uploaded as they are encoded, not {video_file.output} ones")
+			video_file.wait()
+			return None
+		return stream_digest(video_file)
+	with VideoChunks(video_path(video_file)) as chunks:
+		return chunks.digest()
+
+
+def upload_to_tiktok(video_file, session, part_crcs=None):
+	"""`video_file` is a file name in VIDEOS_DIR or a finished ffmpeg.RenderStream, `part_crcs` the CRCs
+	from `video_digest` when already computed."""
 	url = "https://www.tiktok.com/api/v1/video/upload/auth/?aid=1988"
 	r = session.get(url)
 	if not assert_success(url, r):
 		return False
 
-	aws_auth = AWSSigV4(
-		"vod",
-		region="ap-singapore-1",
-		aws_access_key_id=r.json()["video_token_v5"]["access_key_id"],
-		aws_secret_access_key=r.json()["video_token_v5"]["secret_acess_key"],
-		aws_session_token=r.json()["video_token_v5"]["session_token"],
-	)
-	with open(os.path.join(os.getcwd(), Config.get().videos_dir, video_file), "rb") as f:
-		video_content = f.read()
-	file_size = len(video_content)
-	url = f"https://www.tiktok.com/top/v1?Action=ApplyUploadInner&Version=2020-11-19&SpaceName=tiktok&FileType=video&IsInner=1&FileSize={file_size}&s=g158iqx8434"
+	aws_auth = video_aws_auth(r.json())
+	path = video_path(video_file)
+	url = apply_upload_url(os.path.getsize(path))
 
 	r = session.get(url, auth=aws_auth)
 	if not assert_success(url, r):
 		return False
 
 	# upload chunks
-	upload_node = r.json()["Result"]["InnerUploadAddress"]["UploadNodes"][0]
-	video_id = upload_node["Vid"]
-	store_uri = upload_node["StoreInfos"][0]["StoreUri"]
-	video_auth = upload_node["StoreInfos"][0]["Auth"]
-	upload_host = upload_node["UploadHost"]
-	session_key = upload_node["SessionKey"]
-	chunk_size = 5242880
-	chunks = []
-	i = 0
-	while i < file_size:
-		chunks.append(video_content[i: i + chunk_size])
-		i += chunk_size
-	crcs = []
+	video_id, store_uri, video_auth, upload_host, session_key = parse_upload_node(r.json())
 	upload_id = str(uuid.uuid4())
-	for i in range(len(chunks)):
-		chunk = chunks[i]
-		crc = crc32(chunk)
-		crcs.append(crc)
-		url = f"https://{upload_host}/{store_uri}?partNumber={i + 1}&uploadID={upload_id}&phase=transfer"
-		headers = {
-			"Authorization": video_auth,
-			"Content-Type": "application/octet-stream",
-			"Content-Disposition": 'attachment; filename="undefined"',
-			"Content-Crc32": crc,
-		}
-
-		r = session.post(url, headers=headers, data=chunk)
+	crcs = upload_parts(session, path, upload_host, store_uri, upload_id, video_auth, part_crcs)
+	if not crcs:
+		return False
 
 	return video_id, session_key, upload_id, crcs, upload_host, store_uri, video_auth, aws_auth
 
 
+def video_aws_auth(auth_response):
+	return AWSSigV4(
+		"vod",
+		region="ap-singapore-1",
+		aws_access_key_id=auth_response["video_token_v5"]["access_key_id"],
+		aws_secret_access_key=auth_response["video_token_v5"]["secret_acess_key"],
+		aws_session_token=auth_response["video_token_v5"]["session_token"],
+	)
+
+
+def apply_upload_url(file_size):
+	return f"https://www.tiktok.com/top/v1?Action=ApplyUploadInner&Version=2020-11-19&SpaceName=tiktok&FileType=video&IsInner=1&FileSize={file_size}&s=g158iqx8434"
+
+
+def parse_upload_node(apply_response):
+	"""Returns (video_id, store_uri, video_auth, upload_host, session_key) from an ApplyUploadInner response."""
+	upload_node = apply_response["Result"]["InnerUploadAddress"]["UploadNodes"][0]
+	return upload_node["Vid"], upload_node["StoreInfos"][0]["StoreUri"], upload_node["StoreInfos"][0]["Auth"], upload_node["UploadHost"], upload_node["SessionKey"]
+
+
+def part_headers(video_auth, crc):
+	return {
+		"Authorization": video_auth,
+		"Content-Type": "application/octet-stream",
+		"Content-Disposition": 'attachment; filename="undefined"',
+		"Content-Crc32": crc,
+	}
+
+
+def upload_parts(session, video_path, upload_host, store_uri, upload_id, video_auth, part_crcs=None):
+	"""Sends the video parts with up to `upload_concurrency` parts in flight, each part being retried on failure.
+	`part_crcs` skips hashing the parts when their CRCs are already known.
+	Returns the part CRCs ordered by part number, or False when a part could not be uploaded."""
+	config = Config.get()
+	concurrency = max(1, config.upload_concurrency)
+
+	with VideoChunks(video_path, crcs=part_crcs) as chunks:
+		crcs = [None] * len(chunks)
+		in_flight = set()
+		failed = False
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			for chunk in chunks:
+				if len(in_flight) >= concurrency:
+					done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+					if not all(f.result() for f in done):
+						failed = True
+						break
+				in_flight.add(executor.submit(_upload_part, session, chunk, crcs, upload_host, store_uri, upload_id, video_auth, config.upload_part_retries, config.upload_part_timeout))
+			done, _ = wait(in_flight)
+			failed = failed or not all(f.result() for f in done)
+
+	if failed:
+		print("[-] Could not upload video parts")
+		return False
+	return crcs
+
+
+def _upload_part(session, chunk, crcs, upload_host, store_uri, upload_id, video_auth, retries, timeout):
+	try:
+		crc = chunk.crc
+		url = f"https://{upload_host}/{store_uri}?partNumber={chunk.number}&uploadID={upload_id}&phase=transfer"
+		headers = part_headers(video_auth, crc)
+		for attempt in range(retries + 1):
+			if attempt:
+				print(f"[-] Retrying part {chunk.number} ({attempt}/{retries})")
+				time.sleep(min(2 ** attempt, 10))
+			chunk.seek(0)
+			try:
+				# A stalled connection raises after `timeout` seconds without data and is retried.
+				r = session.post(url, headers=headers, data=chunk, timeout=timeout)
+			except requests.RequestException as e:
+				print(f"[-] Part {chunk.number} failed: {e}")
+				continue
+			if assert_success(url, r):
+				# CRCs are stored by part number, the finish phase needs them in order.
+				crcs[chunk.number - 1] = crc
+				return True
+		return False
+	finally:
+		chunk.release()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,280 @@
+import asyncio, json, os, time, uuid
+import aiohttp, requests
+from tiktok_uploader.bot_utils import *
+from tiktok_uploader.signer import SignerClient
+from tiktok_uploader.sessions import AsyncSessionPool, TIKTOK_URL
+from tiktok_uploader.tiktok import load_session, validate_upload, video_path, video_digest, finish_payload, commit_payload, build_post_data, video_aws_auth, apply_upload_url, parse_upload_node, part_headers, project_post_sign_url, project_post_params, poll_backoff, project_status, report_project_status, PROJECT_POST_URL, PROJECT_PENDING_STATUSES
+from tiktok_uploader.Config import Config
+from tiktok_uploader.upload_index import UploadIndex, TitleIndex
+
+
+
+async def upload_video_async(session_user, video, title, schedule_time=0, allow_comment=1, allow_duet=0, allow_stitch=0, visibility_type=0, brand_organic_type=0, branded_content_type=0, ai_label=0, proxy=None, allow_duplicate=False):
+	"""Asyncio counterpart of `tiktok.upload_video`, running the same steps on aiohttp so many
+	accounts can upload concurrently from one event loop, e.g. with `asyncio.gather`. Sessions are
+	kept per account and proxy, await `AsyncSessionPool.get().close()` once the uploads are done.
+	Returns like `tiktok.upload_video`, None when the video was already sent to the user."""
+	session_id, dc_id = load_session(session_user)
+	if not session_id:
+		print(f"[-] No cookie with Tiktok session id found for {session_user}: use login to save session id")
+		return False
+	print(f"[{session_user}] Uploading video...")
+	if not validate_upload(title, schedule_time, visibility_type):
+		return False
+
+	# Hashed off the event loop, before anything is sent.
+	digest = await asyncio.to_thread(video_digest, video)
+	if not digest:
+		return False
+	sha256, part_crcs = digest
+	creation_id = generate_random_string(21, True)
+	previous = UploadIndex.get().claim(sha256, session_user, creation_id, force=allow_duplicate)
+	if previous:
+		print(f"[-] This video was already sent to {session_user} (status {previous['status']}, creation id {previous['creation_id']}), use allow_duplicate to send it again")
+		return None
+
+	# Connections are reused between the uploads of an account.
+	http = AsyncSessionPool.get().session(session_user, session_id, dc_id, proxy)
+	user_agent = http.headers["User-Agent"]
+	uploaded = False
+	try:
+		uploaded = await _upload(http, user_agent, session_user, video, title, creation_id, sha256, part_crcs, schedule_time, allow_comment, allow_duet, allow_stitch, visibility_type, ai_label, proxy or None)
+	finally:
+		UploadIndex.get().finish(sha256, session_user, uploaded)
+	if uploaded:
+		TitleIndex.get().add(session_user, [title], "upload")
+	return uploaded
+
+
+async def _upload(http, user_agent, session_user, video, title, creation_id, sha256, part_crcs, schedule_time, allow_comment, allow_duet, allow_stitch, visibility_type, ai_label, proxy):
+	project_url = f"https://www.tiktok.com/api/v1/web/project/create/?creation_id={creation_id}&type=1&aid=1988"
+	r = await _request(http, "POST", project_url, proxy=proxy)
+	if not r:
+		return False
+
+	# get project_id
+	project_id = r["project"]["project_id"]
+	uploaded_parts = await upload_to_tiktok_async(video, http, proxy, part_crcs)
+	if not uploaded_parts:
+		return False
+	video_id, session_key, upload_id, crcs, upload_host, store_uri, video_auth, aws_auth = uploaded_parts
+	UploadIndex.get().update(sha256, session_user, video_id=video_id)
+
+	url = f"https://{upload_host}/{store_uri}?uploadID={upload_id}&phase=finish&uploadmode=part"
+	headers = {
+		"Authorization": video_auth,
+		"Content-Type": "text/plain;charset=UTF-8",
+	}
+	if await _request(http, "POST", url, headers=headers, data=finish_payload(crcs), proxy=proxy) is False:
+		return False
+
+	url = f"https://www.tiktok.com/top/v1?Action=CommitUploadInner&Version=2020-11-19&SpaceName=tiktok"
+	data = commit_payload(session_key)
+	if await _request(http, "POST", url, headers=aws_headers(aws_auth, "POST", url, data), data=data, proxy=proxy) is False:
+		return False
+
+	# publish video
+	if await _request(http, "HEAD", "https://www.tiktok.com", headers={"user-agent": user_agent}, proxy=proxy) is False:
+		return False
+
+	headers = {
+		"content-type": "application/json",
+		"user-agent": user_agent
+	}
+	markup_text, text_extra = convert_tags(title, None, await resolve_mentions_async(find_mentions(title), http, proxy))
+	data = build_post_data(title, markup_text, text_extra, project_id, video_id, creation_id, schedule_time, allow_comment, allow_duet, allow_stitch, visibility_type, ai_label)
+	signer = SignerClient.get()
+	poll = poll_backoff()
+	while True:
+		mstoken = http.cookie_jar.filter_cookies(TIKTOK_URL).get("msToken")
+		mstoken = mstoken.value if mstoken else None
+		tt_output = await signer.sign_async(project_post_sign_url(mstoken), user_agent, http)
+		if not tt_output:
+			print("[-] Could not sign project post request")
+			return False
+		async with http.post(PROJECT_POST_URL, params=_query_params(project_post_params(mstoken, tt_output)), data=json.dumps(data), headers=headers, proxy=proxy) as r:
+			try:
+				response = await r.json(content_type=None)
+				if response["status_msg"] == "You are posting too fast. Take a rest.":
+					print("[-] You are posting too fast, try later again")
+					return False
+				print(response)
+				break
+			except Exception as e:
+				pass
+		delay = poll.next_delay()
+		if delay is None:
+			print("[-] Could not upload video, TikTok did not accept the post in time")
+			return False
+		print("[-] Waiting for TikTok to process video...")
+		await asyncio.sleep(delay)
+
+	# The post went through, from here on the video may be published even if its status is never confirmed.
+	UploadIndex.get().update(sha256, session_user, status="posted_unconfirmed")
+
+	# Check if video uploaded successfully
+	url = f"https://www.tiktok.com/api/v1/web/project/list/?aid=1988"
+	poll = poll_backoff(Config.get().poll_status_deadline)
+	while True:
+		r = await _request(http, "GET", url, proxy=proxy)
+		if not r:
+			return False
+		status = project_status(r["infos"], creation_id)
+		if status is not None and status not in PROJECT_PENDING_STATUSES:
+			if status != "Success":
+				# Rejected by TikTok, it can be sent again.
+				UploadIndex.get().update(sha256, session_user, status="failed")
+			return report_project_status(status)
+		delay = poll.next_delay()
+		if delay is None:
+			return report_project_status(status)
+		await asyncio.sleep(delay)
+
+
+async def upload_to_tiktok_async(video_file, http, proxy=None, part_crcs=None):
+	url = "https://www.tiktok.com/api/v1/video/upload/auth/?aid=1988"
+	r = await _request(http, "GET", url, proxy=proxy)
+	if not r:
+		return False
+
+	aws_auth = video_aws_auth(r)
+	path = video_path(video_file)
+	url = apply_upload_url(os.path.getsize(path))
+	r = await _request(http, "GET", url, headers=aws_headers(aws_auth, "GET", url), proxy=proxy)
+	if not r:
+		return False
+
+	# upload chunks
+	video_id, store_uri, video_auth, upload_host, session_key = parse_upload_node(r)
+	upload_id = str(uuid.uuid4())
+	crcs = await upload_parts_async(http, path, upload_host, store_uri, upload_id, video_auth, proxy, part_crcs)
+	if not crcs:
+		return False
+
+	return video_id, session_key, upload_id, crcs, upload_host, store_uri, video_auth, aws_auth
+
+
+async def upload_parts_async(http, video_path, upload_host, store_uri, upload_id, video_auth, proxy=None, part_crcs=None):
+	"""Async `tiktok.upload_parts`, at most `upload_concurrency` parts are in flight."""
+	config = Config.get()
+	in_flight = asyncio.Semaphore(max(1, config.upload_concurrency))
+
+	async def send(chunk):
+		try:
+			return await _upload_part_async(http, chunk, crcs, upload_host, store_uri, upload_id, video_auth, config.upload_part_retries, config.upload_part_timeout, proxy)
+		finally:
+			in_flight.release()
+
+	with VideoChunks(video_path, crcs=part_crcs) as chunks:
+		crcs = [None] * len(chunks)
+		tasks = []
+		try:
+			for chunk in chunks:
+				# Parts are only read once a slot frees up, memory stays bounded.
+				await in_flight.acquire()
+				if any(t.done() and not _part_sent(t) for t in tasks):
+					in_flight.release()
+					break
+				tasks.append(asyncio.ensure_future(send(chunk)))
+			results = await asyncio.gather(*tasks, return_exceptions=True)
+		finally:
+			# The parts are views of the mapping closed on exit, none may still be running by then.
+			for t in tasks:
+				t.cancel()
+			await asyncio.gather(*tasks, return_exceptions=True)
+
+	for result in results:
+		if isinstance(result, BaseException):
+			print(f"[-] Part upload failed: {result!r}")
+	if not all(result is True for result in results):
+		print("[-] Could not upload video parts")
+		return False
+	return crcs
+
+
+def _part_sent(task):
+	return not task.cancelled() and task.exception() is None and task.result()
+
+
+async def _upload_part_async(http, chunk, crcs, upload_host, store_uri, upload_id, video_auth, retries, timeout, proxy):
+	try:
+		crc = chunk.crc
+		url = f"https://{upload_host}/{store_uri}?partNumber={chunk.number}&uploadID={upload_id}&phase=transfer"
+		headers = part_headers(video_auth, crc)
+		# aiohttp would switch to chunked encoding for a streamed body without it.
+		headers["Content-Length"] = str(len(chunk))
+		for attempt in range(retries + 1):
+			if attempt:
+				print(f"[-] Retrying part {chunk.number} ({attempt}/{retries})")
+				await asyncio.sleep(min(2 ** attempt, 10))
+			try:
+				async with http.post(url, headers=headers, data=_part_body(chunk), proxy=proxy, timeout=aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)) as r:
+					if r.status == 200:
+						# CRCs are stored by part number, the finish phase needs them in order.
+						crcs[chunk.number - 1] = crc
+						return True
+					print(f"[-] An error occured while reaching {url}")
+					print(f"{r.status}")
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				print(f"[-] Part {chunk.number} failed: {e!r}")
+		return False
+	finally:
+		chunk.release()
+
+
+async def _part_body(chunk, block_size=65536):
+	chunk.seek(0)
+	while True:
+		block = chunk.read(block_size)
+		if not block:
+			return
+		yield block
+
+
+async def resolve_mentions_async(handles, http, proxy=None):
+	"""Async `bot_utils.resolve_mentions`, profile pages of uncached handles are fetched concurrently."""
+	cache = mention_cache()
+	user_ids = cache.get_many(handles)
+	missing = [handle for handle in dict.fromkeys(handles) if handle not in user_ids]
+
+	async def fetch(handle):
+		async with http.get("https://www.tiktok.com/@" + handle, headers=mention_headers(), proxy=proxy) as r:
+			return parse_user_id(await r.text()) if r.status == 200 else None
+
+	fetched = dict(zip(missing, await asyncio.gather(*(fetch(handle) for handle in missing))))
+	for handle, user_id in fetched.items():
+		if not user_id:
+			print(f"[-] Could not find user id of @{handle}")
+	fetched = {handle: user_id for handle, user_id in fetched.items() if user_id}
+	cache.set_many(fetched)
+	user_ids.update(fetched)
+	return user_ids
+
+
+async def _request(http, method, url, headers=None, data=None, proxy=None):
+	"""Sends a request and returns its JSON body (None if the body is not JSON), False on a non 200 status."""
+	async with http.request(method, url, headers=headers, data=data, proxy=proxy) as r:
+		if r.status != 200:
+			print(f"[-] An error occured while reaching {url}")
+			print(f"{r.status}")
+			print(f"{await r.read()}")
+			return False
+		try:
+			return await r.json(content_type=None)
+		except ValueError:
+			return None
+
+
+def aws_headers(aws_auth, method, url, data=None):
+	"""Headers `AWSSigV4` would add to a requests call, computed on a prepared request so they can be sent by aiohttp."""
+	request = requests.Request(method, url, data=data).prepare()
+	aws_auth(request)
+	headers = dict(request.headers)
+	# Not signed, keep the session's user agent.
+	headers.pop("User-Agent", None)
+	return headers
+
+
+def _query_params(params):
+	# aiohttp only accepts str/int/float query values.
+	return {k: v if isinstance(v, (int, float)) else str(v) for k, v in params.items() if v is not None}
@@ -0,0 +1,100 @@
+import re
+from functools import lru_cache
+
+
+MAX_TITLE_LENGTH = 2200
+
+# Hashtags, mentions and the plain text runs between them.
+_TOKENS = re.compile(r'#(\w+)|@([\w.-]+)|([^#@]+)')
+# Trailing run of hashtags, like the fixed suffix added to every title in bulk uploads.
+_HASHTAG_SUFFIX = re.compile(r'(?<=\s)#\w+(?:\s+#\w+)*\s*$')
+
+
+class CompiledTitle:
+	"""Markup text and text extra of a title, with the hashtags and mentions it contains.
+	Mentions have an empty user id in `text_extra`, see `with_user_ids`."""
+
+	def __init__(self, text, segments, text_extra, hashtags, mentions, tokens):
+		self.text = text
+		# Plain strings, or (markup tag, symbol, name, tag id) tuples for hashtags and mentions.
+		self._segments = segments
+		self.text_extra = text_extra
+		self.hashtags = hashtags
+		self.mentions = mentions
+		# Number of matched tokens (text runs included), tag ids are numbered by token.
+		self.tokens = tokens
+
+	@property
+	def length(self):
+		return len(self.text)
+
+	@property
+	def is_valid(self):
+		return self.length <= MAX_TITLE_LENGTH
+
+	@property
+	def markup_text(self):
+		return "".join(s if isinstance(s, str) else f'<{s[0]} id="{s[3]}">{s[1]}{s[2]}</{s[0]}>' for s in self._segments)
+
+	def __add__(self, other):
+		"""Splices `other` after this title, its offsets and tag ids are shifted."""
+		shift = len(self.text)
+		segments = [s if isinstance(s, str) else (s[0], s[1], s[2], s[3] + self.tokens) for s in other._segments]
+		text_extra = [{**extra, "start": extra["start"] + shift, "end": extra["end"] + shift, "tag_id": str(int(extra["tag_id"]) + self.tokens)}
+					  for extra in other.text_extra]
+		return CompiledTitle(self.text + other.text, self._segments + segments, self.text_extra + text_extra,
+							 self.hashtags + other.hashtags, self.mentions + other.mentions, self.tokens + other.tokens)
+
+	def with_user_ids(self, user_ids):
+		"""Returns `text_extra` with the mention user ids taken from `user_ids` ({handle: user_id})."""
+		mentions = iter(self.mentions)
+		return [{**extra, "user_id": user_ids.get(next(mentions), "")} if extra["type"] == 0 else extra for extra in self.text_extra]
+
+
+def compile_title(text):
+	"""Compiles `text` in one pass. A trailing run of hashtags is compiled on its own and memoized,
+	so titles sharing the same hashtag suffix only pay for their own text."""
+	match = _HASHTAG_SUFFIX.search(text)
+	if match:
+		return _compile(text[:match.start()]) + _compile(text[match.start():])
+	return _compile(text)
+
+
+@lru_cache(maxsize=1024)
+def _compile(text):
+	segments = []
+	text_extra = []
+	hashtags = []
+	mentions = []
+	position = 0
+	tokens = 0
+	for i, match in enumerate(_TOKENS.finditer(text)):
+		# Lone '#' or '@' characters are not tokens, they are kept as they are.
+		if match.start() > position:
+			segments.append(text[position:match.start()])
+		position = match.end()
+		tokens = i + 1
+		if match.group(1):
+			hashtags.append(match.group(1))
+			text_extra.append(_text_extra_block(match.start(), match.end(), 1, match.group(1), str(i)))
+			segments.append(("h", "#", match.group(1), i))
+		elif match.group(2):
+			mentions.append(match.group(2))
+			text_extra.append(_text_extra_block(match.start(), match.end(), 0, "", str(i)))
+			segments.append(("m", "@", match.group(2), i))
+		else:
+			segments.append(match.group(3))
+	if position < len(text):
+		segments.append(text[position:])
+	return CompiledTitle(text, segments, text_extra, hashtags, mentions, tokens)
+
+
+def _text_extra_block(start, end, type, hashtag_name, tag_id):
+	return {
+		"end": end,
+		"hashtag_name": hashtag_name,
+		"start": start,
+		"tag_id": tag_id,
+		"type": type,
+		"user_id": ""
+	}
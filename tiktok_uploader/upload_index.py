@@ -0,0 +1,159 @@
+import threading, time
+from tiktok_uploader.store import Store
+
+
+# An upload still in progress after this long (seconds) is taken as interrupted, the video can be sent again.
+CLAIM_TIMEOUT = 3600
+
+# A queued video whose upload failed this many times in a row goes to the back of its queue.
+QUEUE_MAX_FAILURES = 3
+
+
+class UploadIndex:
+	"""Videos uploaded from this machine, keyed by the SHA-256 of their content and the account, with
+	their creation id, video id and status ("uploading", "posted_unconfirmed" once TikTok accepted the post,
+	"uploaded" or "failed"). Stored in the `uploads` table of the Store, so every process sharing CACHE_DIR
+	sees the same index."""
+	__instance = None
+	__lock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if UploadIndex.__instance is None:
+			with UploadIndex.__lock:
+				if UploadIndex.__instance is None:
+					UploadIndex.__instance = UploadIndex()
+		return UploadIndex.__instance
+
+	def __init__(self, store=None):
+		self.store = store or Store.get()
+		self.store.execute("CREATE TABLE IF NOT EXISTS uploads (sha256 TEXT NOT NULL, user TEXT NOT NULL, creation_id TEXT, video_id TEXT, status TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (sha256, user))")
+
+	def find(self, sha256, user):
+		"""Returns the indexed upload of this content to `user` as a dict, None if there is none."""
+		rows = self.store.execute("SELECT sha256, user, creation_id, video_id, status, updated FROM uploads WHERE sha256 = ? AND user = ?", (sha256, user))
+		if not rows:
+			return None
+		return dict(zip(("sha256", "user", "creation_id", "video_id", "status", "updated"), rows[0]))
+
+	def claim(self, sha256, user, creation_id, force=False):
+		"""Records the upload of this content to `user` as started, unless it was already uploaded or is being
+		uploaded by another run: then nothing is recorded and that upload is returned. Posts never confirmed
+		may have been published and are refused too. Failed and interrupted uploads are replaced, `force`
+		replaces any. Returns None once claimed."""
+		with self.store.transaction():
+			previous = self.find(sha256, user)
+			if previous and not force and (previous["status"] in ("uploaded", "posted_unconfirmed") or previous["status"] == "uploading" and time.time() - previous["updated"] < CLAIM_TIMEOUT):
+				return previous
+			self.store.execute("INSERT OR REPLACE INTO uploads (sha256, user, creation_id, video_id, status, updated) VALUES (?, ?, ?, NULL, 'uploading', ?)", (sha256, user, creation_id, time.time()))
+		return None
+
+	def update(self, sha256, user, status=None, video_id=None):
+		"""Sets the status and/or video id of a claimed upload."""
+		self.store.execute("UPDATE uploads SET status = COALESCE(?, status), video_id = COALESCE(?, video_id), updated = ? WHERE sha256 = ? AND user = ?", (status, video_id, time.time(), sha256, user))
+
+	def finish(self, sha256, user, uploaded):
+		"""Records the end of a claimed upload, "uploaded" or else "failed" unless the post was already accepted or rejected."""
+		if uploaded:
+			self.update(sha256, user, status="uploaded")
+		else:
+			self.store.execute("UPDATE uploads SET status = 'failed', updated = ? WHERE sha256 = ? AND user = ? AND status = 'uploading'", (time.time(), sha256, user))
+
+
+class TitleIndex:
+	"""Titles published by each account, in the `published_titles` table of the Store. Uploads add their
+	title once they succeed and profile scrapes add the titles they find. Once a profile was scraped to its
+	end it is marked in `scraped_profiles`, later scrapes only have to look at what was posted since the
+	last one."""
+	__instance = None
+	__lock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if TitleIndex.__instance is None:
+			with TitleIndex.__lock:
+				if TitleIndex.__instance is None:
+					TitleIndex.__instance = TitleIndex()
+		return TitleIndex.__instance
+
+	def __init__(self, store=None):
+		self.store = store or Store.get()
+		self.store.execute("CREATE TABLE IF NOT EXISTS published_titles (user TEXT NOT NULL, title TEXT NOT NULL, source TEXT NOT NULL, added REAL NOT NULL, PRIMARY KEY (user, title))")
+		self.store.execute("CREATE TABLE IF NOT EXISTS scraped_profiles (user TEXT PRIMARY KEY, scraped REAL NOT NULL)")
+
+	def titles(self, user, source=None):
+		"""Titles published by `user`, in the order they were added, only those from `source` if given."""
+		if source is None:
+			rows = self.store.execute("SELECT title FROM published_titles WHERE user = ? ORDER BY added, rowid", (user,))
+		else:
+			rows = self.store.execute("SELECT title FROM published_titles WHERE user = ? AND source = ? ORDER BY added, rowid", (user, source))
+		return [title for title, in rows]
+
+	def add(self, user, titles, source):
+		"""Adds titles published by `user`, oldest first, `source` tells where they come from ("upload" or "scrape").
+		A scrape finding a title an upload added first makes it a scrape title, later scrapes can stop there."""
+		now = time.time()
+		with self.store.transaction():
+			self.store.executemany("INSERT INTO published_titles (user, title, source, added) VALUES (?, ?, ?, ?) ON CONFLICT (user, title) DO UPDATE SET source = excluded.source WHERE excluded.source = 'scrape'", [(user, title, source, now) for title in titles])
+
+	def fully_scraped(self, user):
+		"""True once the profile of `user` was scraped to its end, its older titles are all indexed."""
+		return bool(self.store.execute("SELECT 1 FROM scraped_profiles WHERE user = ?", (user,)))
+
+	def mark_scraped(self, user):
+		"""Records that the profile of `user` was scraped to its end."""
+		self.store.execute("INSERT OR REPLACE INTO scraped_profiles (user, scraped) VALUES (?, ?)", (user, time.time()))
+
+
+class UploadQueue:
+	"""Videos waiting to be uploaded to each account, in upload order, in the `upload_queue` table of the
+	Store. Items are (url, title), a url is queued once per account until it is removed. Failed uploads
+	are counted on their item with the last error, so one that keeps failing doesn't hold the queue."""
+	__instance = None
+	__lock = threading.Lock()
+
+	@staticmethod
+	def get():
+		if UploadQueue.__instance is None:
+			with UploadQueue.__lock:
+				if UploadQueue.__instance is None:
+					UploadQueue.__instance = UploadQueue()
+		return UploadQueue.__instance
+
+	def __init__(self, store=None):
+		self.store = store or Store.get()
+		self.store.execute("CREATE TABLE IF NOT EXISTS upload_queue (position INTEGER PRIMARY KEY, user TEXT NOT NULL, url TEXT NOT NULL, title TEXT NOT NULL, failures INTEGER NOT NULL DEFAULT 0, last_error TEXT, UNIQUE (user, url))")
+		# Queues created before failures were recorded.
+		columns = [row[1] for row in self.store.execute("PRAGMA table_info(upload_queue)")]
+		if "failures" not in columns:
+			self.store.execute("ALTER TABLE upload_queue ADD COLUMN failures INTEGER NOT NULL DEFAULT 0")
+			self.store.execute("ALTER TABLE upload_queue ADD COLUMN last_error TEXT")
+		# The head of a queue is found without scanning it.
+		self.store.execute("CREATE INDEX IF NOT EXISTS upload_queue_order ON upload_queue (user, position)")
+
+	def extend(self, user, items):
+		"""Appends the (url, title) items not queued yet, queued ones keep their place."""
+		with self.store.transaction():
+			self.store.executemany("INSERT OR IGNORE INTO upload_queue (user, url, title) VALUES (?, ?, ?)", [(user, url, title) for url, title in items])
+
+	def first(self, user):
+		"""The (url, title) next in the queue of `user`, None if it is empty."""
+		rows = self.store.execute("SELECT url, title FROM upload_queue WHERE user = ? ORDER BY position LIMIT 1", (user,))
+		return rows[0] if rows else None
+
+	def remove(self, user, url):
+		"""Removes `url` from the queue of `user`, once it is uploaded or was published meanwhile."""
+		self.store.execute("DELETE FROM upload_queue WHERE user = ? AND url = ?", (user, url))
+
+	def fail(self, user, url, error):
+		"""Records a failed upload of `url` to `user`. After QUEUE_MAX_FAILURES failures in a row it goes to
+		the back of the queue with a new count, the videos behind it get their turn. Returns its failure count,
+		0 once it was moved."""
+		with self.store.transaction():
+			self.store.execute("UPDATE upload_queue SET failures = failures + 1, last_error = ? WHERE user = ? AND url = ?", (error, user, url))
+			rows = self.store.execute("SELECT failures FROM upload_queue WHERE user = ? AND url = ?", (user, url))
+			failures = rows[0][0] if rows else 0
+			if failures >= QUEUE_MAX_FAILURES:
+				self.store.execute("UPDATE upload_queue SET position = (SELECT MAX(position) + 1 FROM upload_queue), failures = 0 WHERE user = ? AND url = ?", (user, url))
+				failures = 0
+		return failures
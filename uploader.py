@@ -6,6 +6,7 @@ from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium_stealth import stealth
 
@@ -14,10 +15,28 @@ from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 
+from tiktok_uploader.Config import Config
+from tiktok_uploader.upload_index import TitleIndex, UploadQueue, QUEUE_MAX_FAILURES
+from cli import DUPLICATE_EXIT_STATUS
+
 
 PATH = f"/home/{os.getlogin()}/TikTok_Uploader"
 
 
+# Appended to every title, kept as one string so it is built once.
+HASHTAGS = (
+    " #Adventure #AdventureAwaits #AdventureSeeker #AmazingPlaces"
+    " #BestEats #BoutiqueHotels #BucketListDestinations"
+    " #CulinaryJourney #DreamDestinations #EpicJourneys #ExoticEats"
+    " #Explore #ExploreTheWorld #FoodExplorer #FoodieFinds"
+    " #GlobalCuisine #HiddenGems #HotelLife #HotelLuxury"
+    " #InspiringPlaces #LuxuryHotels #LuxuryTravel #MustVisitPlaces"
+    " #SpectacularViews #Travel #TravelDiaries #TravelEnthusiast"
+    " #TravelGoals #TravelInspiration #TravelVibes #UnforgettableExperiences"
+    " #VacationDreams #VacationGoals #Wanderlust #WorldWonders #hi #world"
+)
+
+
 class YouTubeConnector:
     """
     A class to connect to the YouTube API and retrieve videos from a channel.
@@ -106,10 +125,17 @@ class YouTubeConnector:
 
 class TikTokScraper:
     """
-    A class to scrape video titles from a TikTok user's profile page.
+    A class to get the video titles published on a TikTok user's profile.
+    Titles are kept in a local index under `username`, fed by the uploads made with the session
+    of that name and by the scrapes. The profile page is scraped to its end once, then only down
+    to the first title a previous scrape found.
     """
 
+    # ChromeDriverManager checks for a new driver on every install(), it is done once per process
+    driver_path = None
+
     def __init__(self, username: str) -> None:
+        self.username = username
         self.url = f"https://www.tiktok.com/@{username}"
         self.driver = None
         self.wait = None
@@ -131,7 +157,9 @@ class TikTokScraper:
         options.add_argument("--disable-dev-shm-usage")  # Overcome limited resource problems
         options.add_argument("--remote-debugging-port=9222")
         # Initialize the Chrome WebDriver
-        self.driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
+        if TikTokScraper.driver_path is None:
+            TikTokScraper.driver_path = ChromeDriverManager().install()
+        self.driver = webdriver.Chrome(service=Service(TikTokScraper.driver_path), options=options)
         
         # Use stealth to bypass bot detection by making the browser appear more like a regular user
         stealth(self.driver,
@@ -147,74 +175,101 @@ class TikTokScraper:
         # Maximize the window to ensure all elements are visible
         self.wait = WebDriverWait(self.driver, 20)
     
-    def scroll_page(self):
-        """Scrolls the page to load more content."""
-        scroll_pause_time = 2  # Pause time between scrolls (adjustable)
+    def scroll_page(self) -> bool:
+        """Scrolls to the bottom of the page, returns False once no more content loads."""
         last_height = self.driver.execute_script(
             "return document.body.scrollHeight")
-        
-        while True:
-            # Scroll down to the bottom of the page
-            self.driver.execute_script(
-                "window.scrollTo(0, document.body.scrollHeight);")
-            time.sleep(scroll_pause_time)  # Wait for the content to load
-            
-            # Calculate new scroll height and compare with the last scroll height
-            new_height = self.driver.execute_script(
-                "return document.body.scrollHeight")
-            if new_height == last_height:  # No more content to load
-                break
-            last_height = new_height
+        self.driver.execute_script(
+            "window.scrollTo(0, document.body.scrollHeight);")
+        try:
+            # Returns as soon as the next videos are loaded instead of sleeping a fixed time
+            WebDriverWait(self.driver, 5).until(
+                lambda driver: driver.execute_script("return document.body.scrollHeight") > last_height)
+            return True
+        except TimeoutException:
+            return False
 
-    def extract_titles(self):
-        """Extracts video titles from the TikTok page."""
+    def extract_titles(self, start: int = 0) -> list:
+        """Extracts the titles of the loaded videos from the `start`th one, newest first.
+        Videos without a title are None, so the list lines up with the video blocks."""
         try:
             # Wait for the presence of div elements with the class 'css-41hm0z'
             div_blocks = self.wait.until(EC.presence_of_all_elements_located((By.CLASS_NAME, 'css-41hm0z')))
-            
-            alt_texts = []  # List to store the video titles or alt text
-            for div in div_blocks:
-                try:
-                    # Wait for the img tag inside each div and extract the alt text
-                    img = WebDriverWait(div, 10).until(EC.presence_of_element_located((By.TAG_NAME, 'img')))
-                    alt_texts.append(img.get_attribute('alt'))
-                except Exception as e:
-                    print(f"Error processing div: {e}")
-            
-            return alt_texts  # Return the list of alt texts (video titles or descriptions)
-
         except Exception as e:
             print(f"Error finding video elements: {e}")
             return []
 
+        alt_texts = []  # List to store the video titles or alt text
+        for div in div_blocks[start:]:
+            try:
+                # Blocks of a batch just scrolled in may still be waiting for their thumbnail
+                imgs = WebDriverWait(div, 3).until(lambda div: div.find_elements(By.TAG_NAME, 'img'))
+            except TimeoutException:
+                print("Error processing div: no thumbnail")
+                imgs = []
+            alt_texts.append(imgs[0].get_attribute('alt') if imgs else None)
+        return alt_texts
+
     def close_driver(self):
         """Closes the Selenium WebDriver instance."""
         if self.driver:
             self.driver.quit()
 
-    def scrape_titles(self):
-        """Main function to execute the scraping."""
-        # Initialize and configure the WebDriver
+    def scrape_new_titles(self, stop: set) -> tuple:
+        """Scrapes the titles posted after the newest one in `stop` (normalized titles), oldest first,
+        and tells whether the scrape got to the end of the profile with every title read. With an
+        empty `stop` the whole profile is scraped. Scrolling stops after the first loaded batch holding
+        a `stop` title, the rest of the batch is still read so new videos listed after pinned ones are
+        not missed."""
         self.setup_driver()
-        # Scroll the page to load content
-        self.scroll_page()
-        # Extract video titles
-        titles = self.extract_titles()
-        # Close the browser
-        self.close_driver()
-        
-        return titles
+        new_titles = []
+        try:
+            seen = 0
+            missing = False
+            while True:
+                titles = self.extract_titles(seen)
+                seen += len(titles)
+                found_stop = False
+                for title in titles:
+                    if title is None:
+                        missing = True
+                        continue
+                    if self.normalize_title(title) in stop:
+                        found_stop = True
+                    else:
+                        new_titles.append(title)
+                if found_stop:
+                    break
+                if not self.scroll_page():
+                    # nothing loaded at all is taken as a failed page, not an empty profile, and a
+                    # profile with unread titles is scraped fully again next time
+                    return new_titles[::-1], seen > 0 and not missing
+        finally:
+            self.close_driver()
+        return new_titles[::-1], False
 
-    def get_titles(self):
-        """Returns titles after postprocessing."""
-        titles = self.scrape_titles()
+    @staticmethod
+    def normalize_title(title: str) -> str:
         # remove after "FULL VIDEO:YouTube:WishYouBestt"
-        for idx in range(len(titles)):
-            if "FULL VIDEO:YouTube:WishYouBestt" in titles[idx]:
-                titles[idx] = titles[idx].split(
-                                "FULL VIDEO:YouTube:WishYouBestt")[0]
-                titles[idx] += "FULL VIDEO:YouTube:WishYouBestt"
-        return titles
+        if "FULL VIDEO:YouTube:WishYouBestt" in title:
+            title = title.split("FULL VIDEO:YouTube:WishYouBestt")[0]
+            title += "FULL VIDEO:YouTube:WishYouBestt"
+        return title
+
+    def get_titles(self):
+        """Returns titles after postprocessing, the indexed ones and those scraped, which are indexed.
+        Titles added by uploads are not stop points, older videos below them may not be indexed yet.
+        Every scraped title is indexed as a scrape one, uploaded videos found on the profile become
+        stop points for the next scrapes."""
+        index = TitleIndex.get()
+        known = index.titles(self.username)
+        fully_scraped = index.fully_scraped(self.username)
+        stop = {self.normalize_title(title) for title in index.titles(self.username, "scrape")} if fully_scraped else set()
+        scraped, complete = self.scrape_new_titles(stop)
+        index.add(self.username, scraped, "scrape")
+        if complete and not fully_scraped:
+            index.mark_scraped(self.username)
+        return list(dict.fromkeys(self.normalize_title(title) for title in known + scraped))
 
 
 class UploadOneShort:
@@ -222,6 +277,8 @@ class UploadOneShort:
     A class to upload one YouTube short to TikTok.
     It selects the oldest YouTube short that is not in the TikTok account.
     Uploads the selected YouTube short to the TikTok account.
+    Shorts not published yet wait in a persistent queue, oldest first, and the published titles
+    are kept in a set, so selecting a short doesn't go through the lists again.
     """
 
     def __init__(self, tiktok_user_name: str, ytb_channel_id: str,
@@ -230,7 +287,8 @@ class UploadOneShort:
         self.repeat_count = repeat_count
         self.tiktok_user_name = tiktok_user_name
         self.youtube_titles_sorted_by_upload_date = []
-        self.tiktok_titles = []
+        self.published_titles = set()
+        self.queue_synced = False
         self.ytb_con = YouTubeConnector(ytb_channel_id)
         self.tiktok_scraper = TikTokScraper(tiktok_user_name)
 
@@ -242,48 +300,57 @@ class UploadOneShort:
         return title
 
     def add_hashtags(self, title: str) -> str:
-        title += " #Adventure #AdventureAwaits #AdventureSeeker #AmazingPlaces"
-        title += " #BestEats #BoutiqueHotels #BucketListDestinations"
-        title += " #CulinaryJourney #DreamDestinations #EpicJourneys #ExoticEats"
-        title += " #Explore #ExploreTheWorld #FoodExplorer #FoodieFinds"
-        title += " #GlobalCuisine #HiddenGems #HotelLife #HotelLuxury"
-        title += " #InspiringPlaces #LuxuryHotels #LuxuryTravel #MustVisitPlaces"
-        title += " #SpectacularViews #Travel #TravelDiaries #TravelEnthusiast"
-        title += " #TravelGoals #TravelInspiration #TravelVibes #UnforgettableExperiences"
-        title += " #VacationDreams #VacationGoals #Wanderlust #WorldWonders #hi #world"
-        return title
+        return title + HASHTAGS
 
-    def select_youtube_short(self) -> tuple:
+    def sync_queue(self) -> None:
+        """Queues the YouTube shorts not published yet, once per run. Shorts already queued keep
+        their place and new ones go at the end, so the queue stays oldest first. A short leaves
+        the queue once it is uploaded."""
+        if not self.published_titles:
+            self.published_titles = set(self.tiktok_scraper.get_titles())
         self.youtube_titles_sorted_by_upload_date = self.ytb_con.get_videos(self.youtube_titles_sorted_by_upload_date)
-        #print(self.youtube_titles_sorted_by_upload_date)
-        selection_list = [(url, self.convert_title(title)) for url, title in self.youtube_titles_sorted_by_upload_date]
-        if self.tiktok_titles == []:
-            self.tiktok_titles = self.tiktok_scraper.get_titles()
-
-        # select the oldest youtube short that is not in tiktok_titles
-        for url, title in selection_list:
-           if title not in self.tiktok_titles:
-                title = self.add_hashtags(title)
-                # find index of url in self.youtube_titles_sorted_by_upload_date
-                idx = 0
-                for i, (u, t) in enumerate(self.youtube_titles_sorted_by_upload_date):
-                    if u == url:
-                        idx = i
-                        break
-                # remove the selected title from the list
-                self.youtube_titles_sorted_by_upload_date.pop(idx)
-                self.tiktok_titles.append(title)
+        shorts = [(url, self.convert_title(title)) for url, title in self.youtube_titles_sorted_by_upload_date]
+        UploadQueue.get().extend(self.tiktok_user_name, [(url, title) for url, title in shorts if title not in self.published_titles])
+        self.queue_synced = True
+
+    def select_youtube_short(self) -> tuple:
+        """Returns the (url, title) of the oldest queued short not published yet. It stays queued
+        until its upload succeeds or is refused as a duplicate, a short failing QUEUE_MAX_FAILURES
+        times in a row goes to the back of the queue."""
+        if not self.queue_synced:
+            self.sync_queue()
+        queue = UploadQueue.get()
+
+        # select the oldest youtube short that is not in published_titles
+        while True:
+            short = queue.first(self.tiktok_user_name)
+            if short is None:
+                raise Exception("No new youtube short found")
+            url, title = short
+            if title not in self.published_titles:
                 return url, title
-        raise Exception("No new youtube short found")
+            # shorts published since they were queued are dropped
+            queue.remove(self.tiktok_user_name, url)
 
     def upload_one_short(self, param:list = []) -> None:
         if param != []:
             self.youtube_titles_sorted_by_upload_date = param
+            self.queue_synced = False
         url, title = self.select_youtube_short()
-        print(url, title)
-        command = f"/home/{os.getlogin()}/py_env/bin/python3 ~/TikTok_Uploader/cli.py upload --user wishyouubest -yt \"{url}\" -t \"{title}\""
-        os.system(command)
-        print("Uploaded")
+        print(url, self.add_hashtags(title))
+        command = f"/home/{os.getlogin()}/py_env/bin/python3 ~/TikTok_Uploader/cli.py upload --user wishyouubest -yt \"{url}\" -t \"{self.add_hashtags(title)}\""
+        status = os.waitstatus_to_exitcode(os.system(command))
+        if status in (0, DUPLICATE_EXIT_STATUS):
+            # the short is done once it is on TikTok, or was already sent and would be refused again
+            UploadQueue.get().remove(self.tiktok_user_name, url)
+            self.published_titles.add(title)
+            print("Uploaded" if status == 0 else "[-] Already sent to TikTok, removed from the queue")
+        else:
+            failures = UploadQueue.get().fail(self.tiktok_user_name, url, f"cli.py upload exited with status {status}")
+            if failures:
+                print(f"[-] Upload failed ({failures}/{QUEUE_MAX_FAILURES}), the short stays first in the queue")
+            else:
+                print(f"[-] Upload failed {QUEUE_MAX_FAILURES} times, the short goes to the back of the queue")
         time.sleep(self.wait_time_in_hours * 3600)
         if self.repeat_count > 0:
             self.repeat_count -= 1
@@ -291,6 +358,8 @@ class UploadOneShort:
 
 
 if __name__ == "__main__":
+    # Same config as cli.py, the uploads it makes index their titles in the same CACHE_DIR
+    Config.load(PATH + "/config.txt")
     wait_time_in_hours = 1
     repeat_count = 6
     tiktok_user_name = "wishyouubest"